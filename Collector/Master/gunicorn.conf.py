@@ -0,0 +1,11 @@
+import os
+
+# production serving : WORKERS processes of THREADS threads, each process has its own pool
+# the registry lives in memory and only sees its own process writes, keep one worker
+bind = '0.0.0.0:5000'
+workers = int(os.environ.get("WORKERS", 1))
+# a /registry/changes long-poll holds one thread
+threads = int(os.environ.get("THREADS", 16))
+worker_class = 'gthread'
+timeout = int(os.environ.get("TIMEOUT", 60))
+accesslog = '-'
@@ -1,45 +1,378 @@
 from flask import Flask, json, request
 import mysql.connector
 from mysql.connector import Error
+from mysql.connector.constants import ClientFlag
+from collections import deque
 import os
+import queue
+import threading
+import time
 
 api = Flask(__name__)
 
+# bounded MySQL connection pool : at most POOL_SIZE connections, a request waits POOL_WAIT seconds for a free one
+POOL_SIZE = int(os.environ.get("POOL_SIZE", 10))
+POOL_WAIT = float(os.environ.get("POOL_WAIT", 5))
+
+pool = queue.LifoQueue()
+poolLock = threading.Lock()
+poolStats = {'size': 0, 'in_use': 0, 'checkouts': 0, 'waits': 0, 'timeouts': 0, 'errors': 0,
+    'wait_time': 0.0, 'max_wait_time': 0.0, 'checkout_time': 0.0, 'max_checkout_time': 0.0}
+checkouts = {}
+
+# registration writes are grouped : one transaction for up to GROUP_COMMIT_SIZE rows arrived within GROUP_COMMIT_WAIT seconds
+GROUP_COMMIT_SIZE = int(os.environ.get("GROUP_COMMIT_SIZE", 500))
+GROUP_COMMIT_WAIT = float(os.environ.get("GROUP_COMMIT_WAIT", 0.02))
+
+# a pod is identified by (namespace, pod), registering it again only refreshes its row
+UPSERT = """INSERT INTO registration (host, pod, namespace, ip, groupname, service, port) VALUES (%s, %s, %s, %s, %s, %s, %s) 
+    ON DUPLICATE KEY UPDATE host = VALUES(host), ip = VALUES(ip), groupname = VALUES(groupname), service = VALUES(service), 
+    port = VALUES(port), active = TRUE, updated_at = NOW()"""
+UNREGISTER = "UPDATE registration SET active = FALSE, updated_at = NOW() WHERE namespace = %s AND pod = %s"
+
+writes = queue.Queue()
+writer = None
+writerLock = threading.Lock()
+writerStats = {'batches': 0, 'items': 0, 'rows': 0, 'errors': 0, 'max_batch': 0}
+
+# in-memory registry of every registration, indexed by pod, ip, host and group, rebuilt from MySQL on first use
+# version grows by one per changed row (starting from load time in ms), the last REGISTRY_HISTORY changes serve deltas
+# a long-poll on /registry/changes waits at most REGISTRY_WAIT seconds
+REGISTRY_HISTORY = int(os.environ.get("REGISTRY_HISTORY", 10000))
+REGISTRY_WAIT = float(os.environ.get("REGISTRY_WAIT", 30))
+
+registry = {'loaded': False, 'version': 0, 'pods': {}, 'ip': {}, 'host': {}, 'group': {}}
+changes = deque()
+registryChanged = threading.Condition()
+
 @api.route('/register', methods=['POST'])
 def register():
-    content = request.json
-    db = connect()
-    if db != None:
-        cursor = db.cursor()
-        cursor.execute("INSERT INTO registration (host, pod, namespace, ip, groupname, service, port) VALUES (%s, %s, %s, %s, %s, %s, %s)", (content['host'], content['name'], content['namespace'], content['ip'], content['group'], content['service'], content['port']))
-        db.commit()
-        db.close()
-    else:
+    row = getRegistration(request.json)
+    if row == None:
+        return json.dumps({"status": False, "message": "Invalid registration"}), 400
+    if submit('register', [row]) == None:
         return json.dumps({"status": False, "message": "Unable to connect to master db"})
     return json.dumps({"status": True, "message": "OK"})
 
+@api.route('/register/bulk', methods=['POST'])
+def registerBulk():
+    content = request.json
+    rows = [getRegistration(item) for item in content] if isinstance(content, list) else [None]
+    if None in rows:
+        return json.dumps({"status": False, "message": "Invalid registration list"}), 400
+    if len(rows) and submit('register', rows) == None:
+        return json.dumps({"status": False, "message": "Unable to connect to master db"})
+    return json.dumps({"status": True, "message": "OK", "count": len(rows)})
+
 @api.route('/unregister', methods=['POST'])
 def unregister():
     content = request.json
-    db = connect()
-    if db != None:
-        cursor = db.cursor()
-        cursor.execute("UPDATE registration SET active = FALSE, updated_at = NOW() WHERE host = %s AND namespace = %s", (content['host'], content['namespace']))
-        db.commit()
-        db.close()
-    else:
+    if not isinstance(content, dict) or not content.get('namespace') or not content.get('name'):
+        return json.dumps({"status": False, "message": "Invalid registration"}), 400
+    count = submit('unregister', [(content['namespace'], content['name'])])
+    if count == None:
         return json.dumps({"status": False, "message": "Unable to connect to master db"})
-    if cursor.rowcount > 0:
+    if count > 0:
         return json.dumps({"status": True, "message": "OK"})
     return json.dumps({"status": False, "message": "Unable to find pod"})
 
-def connect():
+@api.route('/registry', methods=['GET'])
+def registrySnapshot():
+    if not loadRegistry():
+        return json.dumps({"status": False, "message": "Unable to connect to master db"})
+    with registryChanged:
+        version = registry['version']
+        registrations = sorted(registry['pods'].values(), key=lambda registration: registration['id'])
+    headers = {'ETag': '"' + str(version) + '"'}
+    if request.if_none_match.contains(str(version)):
+        return '', 304, headers
+    return json.dumps({'version': version, 'registrations': registrations}), 200, headers
+
+@api.route('/registry/changes', methods=['GET'])
+def registryChanges():
+    since = request.args.get('since', '0')
+    wait = request.args.get('wait', '0')
+    if not since.isdigit() or not wait.isdigit():
+        return json.dumps({"status": False, "message": "Invalid since or wait parameter"}), 400
+    if not loadRegistry():
+        return json.dumps({"status": False, "message": "Unable to connect to master db"})
+    since = int(since)
+    with registryChanged:
+        # long-poll : nothing new yet, wait for the next change
+        if registry['version'] == since and int(wait) > 0:
+            registryChanged.wait_for(lambda: registry['version'] != since, timeout=min(int(wait), REGISTRY_WAIT))
+        (version, registrations, snapshot) = getChanges(since)
+    return json.dumps({'version': version, 'snapshot': snapshot, 'changes': registrations})
+
+@api.route('/registry/lookup', methods=['GET'])
+def registryLookup():
+    if not loadRegistry():
+        return json.dumps({"status": False, "message": "Unable to connect to master db"})
+    registrations = []
+    with registryChanged:
+        for index in ('ip', 'host', 'group'):
+            if request.args.get(index, None) != None:
+                registrations += [registry['pods'][key] for key in registry[index].get(request.args.get(index), set())]
+    return json.dumps({'registrations': sorted(registrations, key=lambda registration: registration['id'])})
+
+@api.route('/stats', methods=['GET'])
+def stats():
+    with writerLock:
+        writing = dict(writerStats, pending=writes.qsize())
+    with registryChanged:
+        registered = {'loaded': registry['loaded'], 'version': registry['version'], 'size': len(registry['pods']), 'changes': len(changes)}
+    return json.dumps({'pool': getPoolStats(), 'writer': writing, 'registry': registered})
+
+def getRegistration(content):
+    keys = ['host', 'name', 'namespace', 'ip', 'group', 'service', 'port']
+    if not isinstance(content, dict) or None in [content.get(key) for key in keys]:
+        return None
+    return tuple([content[key] for key in keys])
+
+def submit(kind, rows):
+    # queued for the writer thread, returns the affected pod count once committed (None on failure)
+    global writer
+    with writerLock:
+        if writer == None:
+            writer = threading.Thread(target=write, daemon=True)
+            writer.start()
+    item = {'kind': kind, 'rows': rows, 'result': None, 'done': threading.Event()}
+    writes.put(item)
+    item['done'].wait()
+    return item['result']
+
+def write():
+    while True:
+        batch = [writes.get()]
+        size = len(batch[0]['rows'])
+        deadline = time.time() + GROUP_COMMIT_WAIT
+        while size < GROUP_COMMIT_SIZE:
+            try:
+                item = writes.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                break
+            batch.append(item)
+            size += len(item['rows'])
+        try:
+            if not commit(batch) and len(batch) > 1:
+                # a bad item must not fail the others
+                for item in batch:
+                    commit([item])
+        except Exception as e:
+            api.logger.exception("Registration writer failed")
+        finally:
+            for item in batch:
+                item['done'].set()
+        with writerLock:
+            writerStats['batches'] += 1
+            writerStats['items'] += len(batch)
+            writerStats['rows'] += size
+            writerStats['max_batch'] = max(writerStats['max_batch'], size)
+
+def commit(batch):
+    conn = acquire()
+    if conn == None:
+        return False
+    try:
+        cursor = conn.cursor()
+        # arrival order is kept, a pod restarted within a batch ends up active
+        registrations = []
+        for item in batch:
+            if item['kind'] == 'register':
+                registrations += item['rows']
+                continue
+            if len(registrations):
+                cursor.executemany(UPSERT, registrations)
+                registrations = []
+            item['count'] = 0
+            for row in item['rows']:
+                cursor.execute(UNREGISTER, row)
+                item['count'] += cursor.rowcount
+        if len(registrations):
+            cursor.executemany(UPSERT, registrations)
+        rows = getWrittenRows(cursor, batch)
+        conn.commit()
+    except Error as e:
+        api.logger.warning("Registration batch of {} items failed : {}".format(len(batch), e))
+        with writerLock:
+            writerStats['errors'] += 1
+        return False
+    finally:
+        release(conn)
+    applyRegistry(rows)
+    for item in batch:
+        item['result'] = item['count'] if item['kind'] == 'unregister' else len(item['rows'])
+    return True
+
+def getWrittenRows(cursor, batch):
+    # rows as committed (ids, flags), read in the writing transaction
+    pods = set()
+    for item in batch:
+        for row in item['rows']:
+            pods.add((row[2], row[1]) if item['kind'] == 'register' else (row[0], row[1]))
+    params = ()
+    for pod in pods:
+        params += pod
+    cursor.execute("SELECT * FROM registration WHERE " + ' OR '.join(['(namespace = %s AND pod = %s)'] * len(pods)), params)
+    list = cursor.fetchall()
+    columns = cursor.description
+    return [associate(row, columns) for row in list]
+
+def loadRegistry():
+    # one bulk read, then kept up to date by the writer
+    with registryChanged:
+        if registry['loaded']:
+            return True
+        conn = acquire()
+        if conn == None:
+            return False
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM registration ORDER BY id")
+            list = cursor.fetchall()
+            columns = cursor.description
+        except Error as e:
+            api.logger.warning("Registry load failed : {}".format(e))
+            return False
+        finally:
+            release(conn)
+        for row in list:
+            indexRegistration(associate(row, columns))
+        registry['version'] = int(time.time() * 1000)
+        registry['loaded'] = True
+        api.logger.info("Registry loaded with {} registrations".format(len(registry['pods'])))
+        return True
+
+def applyRegistry(rows):
+    with registryChanged:
+        if not registry['loaded']:
+            return
+        changed = False
+        for registration in rows:
+            if registry['pods'].get((registration['namespace'], registration['pod'])) == registration:
+                continue
+            indexRegistration(registration)
+            registry['version'] += 1
+            changes.append((registry['version'], registration))
+            changed = True
+        while len(changes) > REGISTRY_HISTORY:
+            changes.popleft()
+        if changed:
+            registryChanged.notify_all()
+
+def indexRegistration(registration):
+    key = (registration['namespace'], registration['pod'])
+    previous = registry['pods'].get(key)
+    if previous != None:
+        for (index, column) in (('ip', 'ip'), ('host', 'host'), ('group', 'groupname')):
+            registry[index][previous[column]].discard(key)
+            if not registry[index][previous[column]]:
+                del registry[index][previous[column]]
+    registry['pods'][key] = registration
+    for (index, column) in (('ip', 'ip'), ('host', 'host'), ('group', 'groupname')):
+        registry[index].setdefault(registration[column], set()).add(key)
+
+def getChanges(since):
+    # latest state of each pod changed after since, everything when since is unknown (too old, other master run)
+    version = registry['version']
+    if since == version:
+        return (version, [], False)
+    if since > version or not len(changes) or since < changes[0][0] - 1:
+        return (version, sorted(registry['pods'].values(), key=lambda registration: registration['id']), True)
+    latest = {}
+    for (changeVersion, registration) in changes:
+        if changeVersion > since:
+            latest[(registration['namespace'], registration['pod'])] = registration
+    return (version, sorted(latest.values(), key=lambda registration: registration['id']), False)
+
+def associate(data, columns):
+    row = {}
+    for (index,column) in enumerate(data):
+        row[columns[index][0]] = column
+    return row
+
+def acquire():
+    tic = time.time()
+    conn = None
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        with poolLock:
+            create = poolStats['size'] < POOL_SIZE
+            if create:
+                poolStats['size'] += 1
+        if create:
+            try:
+                conn = newConnection()
+            except Exception:
+                # give the reserved slot back, the pool would otherwise believe it is full
+                with poolLock:
+                    poolStats['size'] -= 1
+                    poolStats['errors'] += 1
+                raise
+            if conn == None:
+                with poolLock:
+                    poolStats['size'] -= 1
+                    poolStats['errors'] += 1
+                return None
+        else:
+            with poolLock:
+                poolStats['waits'] += 1
+            try:
+                conn = pool.get(timeout=POOL_WAIT)
+            except queue.Empty:
+                with poolLock:
+                    poolStats['timeouts'] += 1
+                return None
+    try:
+        # health check, reconnect a connection dropped by the server
+        conn.ping(reconnect=True, attempts=1, delay=0)
+    except Error as e:
+        with poolLock:
+            poolStats['size'] -= 1
+            poolStats['errors'] += 1
+        return None
+    wait = time.time() - tic
+    with poolLock:
+        poolStats['checkouts'] += 1
+        poolStats['in_use'] += 1
+        poolStats['wait_time'] += wait
+        poolStats['max_wait_time'] = max(poolStats['max_wait_time'], wait)
+        checkouts[id(conn)] = time.time()
+    return conn
+
+def release(conn):
+    with poolLock:
+        held = time.time() - checkouts.pop(id(conn), time.time())
+        poolStats['in_use'] -= 1
+        poolStats['checkout_time'] += held
+        poolStats['max_checkout_time'] = max(poolStats['max_checkout_time'], held)
+    try:
+        # end the transaction (and its read snapshot) before reuse
+        conn.rollback()
+        pool.put(conn)
+    except Error as e:
+        with poolLock:
+            poolStats['size'] -= 1
+            poolStats['errors'] += 1
+
+def getPoolStats():
+    with poolLock:
+        stats = dict(poolStats)
+    stats['limit'] = POOL_SIZE
+    stats['idle'] = pool.qsize()
+    stats['avg_wait_time'] = round(stats['wait_time'] / stats['checkouts'], 6) if stats['checkouts'] else 0
+    stats['avg_checkout_time'] = round(stats['checkout_time'] / stats['checkouts'], 6) if stats['checkouts'] else 0
+    return stats
+
+def newConnection():
     try:
-        conn = mysql.connector.connect(host=os.environ["DB_HOST"], database=os.environ["DB_NAME"], user=os.environ["DB_USER"],password=os.environ["DB_PASSWORD"])
+        # matched (not only changed) rows in rowcount, unregister stays idempotent
+        conn = mysql.connector.connect(host=os.environ["DB_HOST"], database=os.environ["DB_NAME"], user=os.environ["DB_USER"],password=os.environ["DB_PASSWORD"], client_flags=[ClientFlag.FOUND_ROWS])
         if conn.is_connected():
             return conn
         return None
-    except RuntimeError as e:
+    except Error as e:
         return None
 
 if __name__ == '__main__':
@@ -0,0 +1,191 @@
+import os
+import logging
+import re
+import sys
+import mysql.connector
+from mysql.connector import Error
+
+connection = None
+log = None
+
+# forward-only : NNNN_name.sql files are applied in order once, each one recorded in schema_version
+MIGRATIONS = os.environ.get("MIGRATIONS", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations'))
+LOCK_TIMEOUT = int(os.environ.get("LOCK_TIMEOUT", 600))
+# table (1050), column (1060) or index (1061) already there and index already dropped (1091) are fine,
+# a database created by db-sms.yaml or fixed by hand is upgraded the same way
+TOLERATED = (1050, 1060, 1061, 1091)
+# a hot query fails the check when it reads more than CHECK_ROWS rows of a table without an index
+CHECK_ROWS = int(os.environ.get("CHECK_ROWS", 1000))
+
+# same shapes as the hot queries of api-server.py and processor.py
+CHECKS = [
+    ('api aggregates to_id', """SELECT to_id, COUNT(*), SUM(request_time) FROM request
+        WHERE 1 = 1 AND created_at > %s AND created_at < %s GROUP BY to_id""", ('2020-01-01', '2020-01-02')),
+    ('api aggregates to_id filtred', """SELECT to_id, COUNT(*), SUM(request_time) FROM request
+        WHERE 1 = 1 AND to_id IN (1, 2, 3) AND created_at > %s AND created_at < %s GROUP BY to_id""", ('2020-01-01', '2020-01-02')),
+    ('api aggregates from_id', """SELECT from_id, COUNT(*), SUM(request_time) FROM request
+        WHERE 1 = 1 AND from_id IN (SELECT id FROM registration WHERE groupname IN (%s)) AND created_at > %s AND created_at < %s GROUP BY from_id""", ('service', '2020-01-01', '2020-01-02')),
+    ('api aggregates link', """SELECT link, COUNT(*), SUM(response_time) FROM request
+        WHERE 1 = 1 AND created_at > %s AND created_at < %s GROUP BY link""", ('2020-01-01', '2020-01-02')),
+    ('api series in', "SELECT created_at, code FROM request WHERE to_id = %s AND created_at >= %s AND created_at < %s", (1, '2020-01-01', '2020-01-02')),
+    ('api series out', """SELECT created_at, code FROM request WHERE from_id IN (SELECT id FROM registration
+        WHERE groupname = (SELECT name FROM node WHERE id = %s)) AND created_at >= %s AND created_at < %s""", (1, '2020-01-01', '2020-01-02')),
+    ('api series link', "SELECT created_at, code FROM request WHERE link = %s AND created_at >= %s AND created_at < %s", (1, '2020-01-01', '2020-01-02')),
+    ('api rollup', "SELECT to_id, count FROM rollup_minute WHERE 1 = 1 AND to_id IN (1, 2, 3) AND bucket >= %s AND bucket < %s", ('2020-01-01', '2020-01-02')),
+    ('api histograms', "SELECT to_id, metric, bin, count FROM histogram_hour WHERE 1 = 1 AND bucket >= %s AND bucket < %s", ('2020-01-01', '2020-01-02')),
+    ('api services', "SELECT * FROM registration WHERE active = 1 AND namespace = %s AND groupname IN (%s)", ('default', 'service')),
+    ('api groupnames', "SELECT DISTINCT groupname FROM registration WHERE namespace = %s AND active = 1", ('default',)),
+    ('api links', """SELECT * FROM link WHERE (from_id = 0 OR from_id IN (SELECT id FROM registration WHERE active = 1 AND groupname IN (%s)))
+        AND to_id IN (1, 2, 3)""", ('service',)),
+    ('processor registrations', "SELECT * FROM registration WHERE host IN (%s) OR ip IN (%s) ORDER BY id", ('host', '10.0.0.1')),
+    ('processor registration', "SELECT * FROM registration WHERE host LIKE %s or ip LIKE %s", ('host', 'host')),
+    ('processor nodes', "SELECT * FROM node WHERE name IN (%s, %s) ORDER BY id", ('service', 'other')),
+    ('processor links', "SELECT * FROM link WHERE (from_id = %s AND to_id = %s) OR (from_id = %s AND to_id = %s) ORDER BY id", (1, 2, 3, 4)),
+    ('processor claim', "SELECT id, host, message FROM access WHERE claim = %s ORDER BY id", ('claim',)),
+    ('processor active groups', "SELECT groupname, COUNT(*) FROM registration WHERE active = %s GROUP BY groupname", (True,)),
+    ('processor retention', "SELECT id FROM request WHERE created_at < %s", ('2020-01-01',)),
+]
+
+def migrate():
+    cursor = connection.cursor()
+    cursor.execute("""CREATE TABLE IF NOT EXISTS schema_version (
+        version INT UNSIGNED PRIMARY KEY,
+        name VARCHAR(255) NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
+    # one runner at a time, a second job waits then finds nothing to do
+    cursor.execute("SELECT GET_LOCK('sms-migration', %s)", (LOCK_TIMEOUT,))
+    if cursor.fetchone()[0] != 1:
+        raise NameError('Unable to take migration lock')
+    try:
+        current = getVersion()
+        pending = [migration for migration in getMigrations() if migration[0] > current]
+        if not len(pending):
+            logger().info("Schema is up to date at version {}".format(current))
+        for (version, name, path) in pending:
+            apply(version, name, path)
+        return True
+    finally:
+        cursor.execute("SELECT RELEASE_LOCK('sms-migration')")
+        cursor.fetchall()
+
+def apply(version, name, path):
+    logger().info("Applying migration {} {}...".format(version, name))
+    cursor = connection.cursor()
+    with open(path) as file:
+        statements = getStatements(file.read())
+    # DDL commits implicitly in MySQL, statements are written to be replayed if a migration stops halfway
+    for statement in statements:
+        try:
+            cursor.execute(statement)
+            if cursor.with_rows:
+                cursor.fetchall()
+        except Error as e:
+            if e.errno not in TOLERATED:
+                logger().error("Migration {} failed on : {}".format(version, statement))
+                raise
+            logger().info("Skipped, already applied : {}".format(e.msg))
+    cursor.execute("INSERT INTO schema_version (version, name) VALUES (%s, %s)", (version, name))
+    connection.commit()
+
+def status():
+    current = getVersion()
+    for (version, name, path) in getMigrations():
+        logger().info("{} {} {}".format(version, name, "applied" if version <= current else "pending"))
+    return True
+
+def check():
+    cursor = connection.cursor(dictionary=True)
+    failed = 0
+    for (name, query, params) in CHECKS:
+        cursor.execute("EXPLAIN " + query, params)
+        for row in cursor.fetchall():
+            if row['type'] != 'ALL' or row['table'] == None or row['table'].startswith('<'):
+                continue
+            if row['rows'] != None and row['rows'] > CHECK_ROWS:
+                failed += 1
+                logger().error("{} : full scan of {} ({} rows)".format(name, row['table'], row['rows']))
+            else:
+                logger().info("{} : full scan of small table {} ({} rows)".format(name, row['table'], row['rows']))
+        logger().info("{} : checked".format(name))
+    logger().info("{} of {} queries need a full scan".format(failed, len(CHECKS)))
+    return failed == 0
+
+def getVersion():
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT MAX(version) FROM schema_version")
+    except Error as e:
+        if e.errno == 1146:
+            return 0
+        raise
+    version = cursor.fetchone()[0]
+    return version if version != None else 0
+
+def getMigrations():
+    migrations = []
+    for file in sorted(os.listdir(MIGRATIONS)):
+        match = re.match(r'^(\d+)_(\w+)\.sql$', file)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(MIGRATIONS, file)))
+    versions = [version for (version, name, path) in migrations]
+    if len(versions) != len(set(versions)):
+        raise NameError('Duplicate migration version in ' + MIGRATIONS)
+    return migrations
+
+def getStatements(sql):
+    # one statement per ';' ending a line, '--' comments are dropped
+    statements, lines = [], []
+    for line in sql.splitlines():
+        if line.strip().startswith('--'):
+            continue
+        lines.append(line)
+        if line.rstrip().endswith(';'):
+            statement = '\n'.join(lines).strip().rstrip(';').strip()
+            if statement:
+                statements.append(statement)
+            lines = []
+    if '\n'.join(lines).strip():
+        statements.append('\n'.join(lines).strip())
+    return statements
+
+def connect():
+    global connection
+    if connection == None or not connection.is_connected():
+        try:
+            connection = mysql.connector.connect(
+                host=os.environ["DB_HOST"], 
+                database=os.environ["DB_NAME"], 
+                user=os.environ["DB_USER"],
+                password=os.environ["DB_PASSWORD"])
+            if connection.is_connected():
+                connection.autocommit = False
+                return connection
+            return None
+        except Error as e:
+            logger().error("Unable to connect to database : {}".format(e))
+            return None
+    return connection
+
+def logger():
+    global log
+    if log != None:
+        return log
+    log = logging.getLogger(__name__)
+    out_hdlr = logging.StreamHandler(sys.stdout)
+    out_hdlr.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    out_hdlr.setLevel(logging.INFO)
+    log.addHandler(out_hdlr)
+    log.setLevel(logging.INFO)
+    return log
+
+if __name__ == '__main__':
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'up'
+    if not connect():
+        raise NameError('Unable to connect to database')
+    if mode == 'status':
+        ok = status()
+    elif mode == 'check':
+        ok = check()
+    else:
+        ok = migrate()
+    sys.exit(0 if ok else 1)
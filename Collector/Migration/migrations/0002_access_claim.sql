@@ -0,0 +1,4 @@
+-- claimed batches of the daemon workers
+ALTER TABLE access ADD COLUMN claim VARCHAR(32) DEFAULT NULL;
+ALTER TABLE access ADD COLUMN claimed_at TIMESTAMP NULL DEFAULT NULL;
+CREATE INDEX claimidx ON access(claim);
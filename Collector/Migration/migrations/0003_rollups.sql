@@ -0,0 +1,31 @@
+-- pre-aggregated minute and hour buckets written by the processor
+CREATE TABLE IF NOT EXISTS rollup_minute (
+  bucket DATETIME NOT NULL,
+  link INT(6) UNSIGNED NOT NULL,
+  from_id INT(6) UNSIGNED NOT NULL,
+  to_id INT(6) UNSIGNED NOT NULL,
+  count INT UNSIGNED NOT NULL DEFAULT 0,
+  2xx INT UNSIGNED NOT NULL DEFAULT 0,
+  3xx INT UNSIGNED NOT NULL DEFAULT 0,
+  4xx INT UNSIGNED NOT NULL DEFAULT 0,
+  5xx INT UNSIGNED NOT NULL DEFAULT 0,
+  request_time DOUBLE NOT NULL DEFAULT 0,
+  response_time DOUBLE NOT NULL DEFAULT 0,
+  PRIMARY KEY (bucket, link)
+);
+CREATE INDEX rollupminutetoidx ON rollup_minute(to_id, bucket);
+CREATE INDEX rollupminutefromidx ON rollup_minute(from_id, bucket);
+CREATE TABLE IF NOT EXISTS rollup_hour LIKE rollup_minute;
+CREATE TABLE IF NOT EXISTS histogram_minute (
+  bucket DATETIME NOT NULL,
+  link INT(6) UNSIGNED NOT NULL,
+  from_id INT(6) UNSIGNED NOT NULL,
+  to_id INT(6) UNSIGNED NOT NULL,
+  metric TINYINT UNSIGNED NOT NULL,
+  bin TINYINT UNSIGNED NOT NULL,
+  count INT UNSIGNED NOT NULL DEFAULT 0,
+  PRIMARY KEY (bucket, link, metric, bin)
+);
+CREATE INDEX histogramminutetoidx ON histogram_minute(to_id, bucket);
+CREATE INDEX histogramminutefromidx ON histogram_minute(from_id, bucket);
+CREATE TABLE IF NOT EXISTS histogram_hour LIKE histogram_minute;
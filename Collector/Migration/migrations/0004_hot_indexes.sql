@@ -0,0 +1,12 @@
+-- raw aggregates and histograms : created_at window read from the index only
+CREATE INDEX requestwindowidx ON request(created_at, to_id, from_id, link, code, request_time, response_time);
+-- series of one node or link over a window
+CREATE INDEX requesttoidx ON request(to_id, created_at);
+CREATE INDEX requestfromidx ON request(from_id, created_at);
+CREATE INDEX requestlinkidx ON request(link, created_at);
+-- processor host or ip lookup, api services and groupnames
+CREATE INDEX ipidx ON registration(ip);
+CREATE INDEX groupidx ON registration(groupname, active);
+CREATE INDEX activeidx ON registration(active, namespace, groupname);
+-- expired claims of the daemon workers
+CREATE INDEX claimedidx ON access(claimed_at);
@@ -0,0 +1,57 @@
+-- duplicates are merged into the oldest row and every reference moves to it, so no request or rollup is lost.
+-- DML only until the first CREATE INDEX : a failure rolls the whole merge back
+-- one registration per pod : active if any duplicate was
+CREATE TEMPORARY TABLE registration_remap AS SELECT r.id AS old_id, d.id AS new_id FROM registration r
+  JOIN (SELECT namespace, pod, MIN(id) AS id FROM registration GROUP BY namespace, pod HAVING COUNT(*) > 1) d ON r.namespace = d.namespace AND r.pod = d.pod AND r.id != d.id;
+UPDATE registration r JOIN (SELECT namespace, pod, MIN(id) AS id, MAX(active) AS active FROM registration GROUP BY namespace, pod HAVING COUNT(*) > 1) d
+  ON r.id = d.id SET r.active = d.active;
+UPDATE request r JOIN registration_remap m ON r.from_id = m.old_id SET r.from_id = m.new_id;
+UPDATE link r JOIN registration_remap m ON r.from_id = m.old_id SET r.from_id = m.new_id;
+UPDATE rollup_minute r JOIN registration_remap m ON r.from_id = m.old_id SET r.from_id = m.new_id;
+UPDATE rollup_hour r JOIN registration_remap m ON r.from_id = m.old_id SET r.from_id = m.new_id;
+UPDATE histogram_minute r JOIN registration_remap m ON r.from_id = m.old_id SET r.from_id = m.new_id;
+UPDATE histogram_hour r JOIN registration_remap m ON r.from_id = m.old_id SET r.from_id = m.new_id;
+DELETE r FROM registration r JOIN registration_remap m ON r.id = m.old_id;
+DROP TEMPORARY TABLE registration_remap;
+-- one node per name
+CREATE TEMPORARY TABLE node_remap AS SELECT n.id AS old_id, d.id AS new_id FROM node n
+  JOIN (SELECT name, MIN(id) AS id FROM node GROUP BY name HAVING COUNT(*) > 1) d ON n.name = d.name AND n.id != d.id;
+UPDATE request r JOIN node_remap m ON r.to_id = m.old_id SET r.to_id = m.new_id;
+UPDATE link r JOIN node_remap m ON r.to_id = m.old_id SET r.to_id = m.new_id;
+UPDATE rollup_minute r JOIN node_remap m ON r.to_id = m.old_id SET r.to_id = m.new_id;
+UPDATE rollup_hour r JOIN node_remap m ON r.to_id = m.old_id SET r.to_id = m.new_id;
+UPDATE histogram_minute r JOIN node_remap m ON r.to_id = m.old_id SET r.to_id = m.new_id;
+UPDATE histogram_hour r JOIN node_remap m ON r.to_id = m.old_id SET r.to_id = m.new_id;
+UPDATE link l JOIN node_remap m ON l.from_node_id = m.old_id SET l.from_node_id = m.new_id;
+DELETE n FROM node n JOIN node_remap m ON n.id = m.old_id;
+DROP TEMPORARY TABLE node_remap;
+-- one link per pair, after the registration and node merges which can make more pairs equal :
+-- rollup and histogram buckets of duplicates are added to the kept link ones
+CREATE TEMPORARY TABLE link_remap AS SELECT l.id AS old_id, d.id AS new_id FROM link l
+  JOIN (SELECT from_id, to_id, MIN(id) AS id FROM link GROUP BY from_id, to_id HAVING COUNT(*) > 1) d ON l.from_id = d.from_id AND l.to_id = d.to_id AND l.id != d.id;
+UPDATE request r JOIN link_remap m ON r.link = m.old_id SET r.link = m.new_id;
+INSERT INTO rollup_minute (bucket, link, from_id, to_id, count, 2xx, 3xx, 4xx, 5xx, request_time, response_time)
+  SELECT r.bucket, m.new_id, r.from_id, r.to_id, r.count, r.2xx, r.3xx, r.4xx, r.5xx, r.request_time, r.response_time FROM rollup_minute r JOIN link_remap m ON r.link = m.old_id
+  ON DUPLICATE KEY UPDATE rollup_minute.count = rollup_minute.count + VALUES(count), rollup_minute.2xx = rollup_minute.2xx + VALUES(2xx), rollup_minute.3xx = rollup_minute.3xx + VALUES(3xx),
+  rollup_minute.4xx = rollup_minute.4xx + VALUES(4xx), rollup_minute.5xx = rollup_minute.5xx + VALUES(5xx), rollup_minute.request_time = rollup_minute.request_time + VALUES(request_time),
+  rollup_minute.response_time = rollup_minute.response_time + VALUES(response_time);
+DELETE r FROM rollup_minute r JOIN link_remap m ON r.link = m.old_id;
+INSERT INTO rollup_hour (bucket, link, from_id, to_id, count, 2xx, 3xx, 4xx, 5xx, request_time, response_time)
+  SELECT r.bucket, m.new_id, r.from_id, r.to_id, r.count, r.2xx, r.3xx, r.4xx, r.5xx, r.request_time, r.response_time FROM rollup_hour r JOIN link_remap m ON r.link = m.old_id
+  ON DUPLICATE KEY UPDATE rollup_hour.count = rollup_hour.count + VALUES(count), rollup_hour.2xx = rollup_hour.2xx + VALUES(2xx), rollup_hour.3xx = rollup_hour.3xx + VALUES(3xx),
+  rollup_hour.4xx = rollup_hour.4xx + VALUES(4xx), rollup_hour.5xx = rollup_hour.5xx + VALUES(5xx), rollup_hour.request_time = rollup_hour.request_time + VALUES(request_time),
+  rollup_hour.response_time = rollup_hour.response_time + VALUES(response_time);
+DELETE r FROM rollup_hour r JOIN link_remap m ON r.link = m.old_id;
+INSERT INTO histogram_minute (bucket, link, from_id, to_id, metric, bin, count)
+  SELECT r.bucket, m.new_id, r.from_id, r.to_id, r.metric, r.bin, r.count FROM histogram_minute r JOIN link_remap m ON r.link = m.old_id
+  ON DUPLICATE KEY UPDATE histogram_minute.count = histogram_minute.count + VALUES(count);
+DELETE r FROM histogram_minute r JOIN link_remap m ON r.link = m.old_id;
+INSERT INTO histogram_hour (bucket, link, from_id, to_id, metric, bin, count)
+  SELECT r.bucket, m.new_id, r.from_id, r.to_id, r.metric, r.bin, r.count FROM histogram_hour r JOIN link_remap m ON r.link = m.old_id
+  ON DUPLICATE KEY UPDATE histogram_hour.count = histogram_hour.count + VALUES(count);
+DELETE r FROM histogram_hour r JOIN link_remap m ON r.link = m.old_id;
+DELETE l FROM link l JOIN link_remap m ON l.id = m.old_id;
+DROP TEMPORARY TABLE link_remap;
+CREATE UNIQUE INDEX podidx ON registration(namespace, pod);
+CREATE UNIQUE INDEX nodeidx ON node(name);
+CREATE UNIQUE INDEX linkpairidx ON link(from_id, to_id);
@@ -0,0 +1,6 @@
+-- raw requests written before rollups were enabled, downsampled by the processor before being purged
+CREATE TABLE IF NOT EXISTS rollup_backfill (
+  id TINYINT UNSIGNED PRIMARY KEY,
+  last_id INT UNSIGNED NOT NULL DEFAULT 0,
+  until_id INT UNSIGNED NOT NULL
+);
@@ -0,0 +1,34 @@
+import re
+from datetime import datetime
+
+# nginx "info" log_format emitted by the controller (setProxyConfigMap) :
+# $remote_addr - $remote_user [$time_local] "$request" $status $body_bytes_sent "$http_referer" "$http_user_agent" -
+# rt=$request_time uct=$upstream_connect_time uht=$upstream_header_time urt=$upstream_response_time
+# quoted fields can't contain '"' (nginx escapes it as \x22), so each field is matched without backtracking
+PATTERN = re.compile(r'([0-9.]+) - [^ ]+ \[([^\]]+)\] "[^"]*" ([0-9]+) [0-9]+ "[^"]*" "[^"]*" - rt=([0-9.]+) uct=[0-9.]+ uht=[0-9.]+ urt=([0-9.]+)')
+TIME_FORMAT = '%d/%b/%Y:%H:%M:%S %z'
+# max distinct timestamps (one per second of traffic) kept before the cache is reset
+TIME_CACHE_SIZE = 4096
+
+times = {}
+
+def parse(message):
+    if not message:
+        return None
+    r = PATTERN.match(message)
+    if not r:
+        return None
+    remoteAddr, time, code, requestTime, responseTime = r.groups()
+    at = times.get(time)
+    if at is None:
+        try:
+            at = datetime.strptime(time, TIME_FORMAT)
+        except ValueError:
+            return None
+        if len(times) >= TIME_CACHE_SIZE:
+            times.clear()
+        times[time] = at
+    return (remoteAddr, at, code, requestTime, responseTime)
+
+def parseBatch(messages):
+    return [parse(message) for message in messages]
@@ -0,0 +1,60 @@
+import random
+import re
+import sys
+import time
+from datetime import datetime, timedelta
+
+import accesslog
+
+AGENTS = [
+    'curl/7.64.0',
+    'python-requests/2.23.0',
+    'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/81.0.4044.138 Safari/537.36',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 13_4_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/13.1 Mobile/15E148 Safari/604.1 ' + 'x' * 400,
+]
+PATHS = ['/', '/products', '/reviews/0', '/ratings/12?verbose=true&lang=en', '/details/' + 'a' * 200]
+
+def corpus(size, malformed = 0.05):
+    lines = []
+    start = datetime(2020, 5, 1, 10, 0, 0)
+    for index in range(size):
+        at = (start + timedelta(seconds=index // 50)).strftime('%d/%b/%Y:%H:%M:%S +0000')
+        line = '10.{}.{}.{} - - [{}] "{} {} HTTP/1.1" {} {} "-" "{}" - rt={:.3f} uct={:.3f} uht={:.3f} urt={:.3f}'.format(
+            random.randint(0, 255), random.randint(0, 255), random.randint(0, 255), at,
+            random.choice(['GET', 'POST', 'PUT']), random.choice(PATHS), random.choice([200, 200, 200, 201, 304, 404, 500, 503]),
+            random.randint(0, 50000), random.choice(AGENTS), random.random(), random.random() / 100, random.random() / 10, random.random())
+        if random.random() < malformed:
+            # truncated syslog datagram, missing upstream (no proxy) or garbage
+            line = random.choice([line[:random.randint(10, len(line) - 1)], line.replace('urt=', 'urt=-  '), 'upstream timed out ' + 'z' * 300])
+        lines.append(line)
+    return lines
+
+def legacy(messages):
+    # processRequest() parsing before accesslog : compiled per line, unanchored .* and strptime each time
+    result = []
+    for message in messages:
+        p = re.compile('([0-9.]+) - .* \\[(.*)\\] ".*" ([0-9]+) [0-9]+ ".*" ".*" - rt=([0-9\\.]+) uct=[0-9\\.]+ uht=[0-9\\.]+ urt=([0-9\\.]+)', re.IGNORECASE)
+        r = p.match(message)
+        if r:
+            result.append((r.group(1), datetime.strptime(r.group(2), '%d/%b/%Y:%H:%M:%S %z'), r.group(3), r.group(4), r.group(5)))
+        else:
+            result.append(None)
+    return result
+
+def measure(name, function, lines):
+    tic = time.perf_counter()
+    result = function(lines)
+    toc = time.perf_counter()
+    valid = len([1 for row in result if row])
+    print("{:<10} {:>10} lines/s  ({} valid, {} invalid, {:.3f} s)".format(name, int(len(lines) / (toc - tic)), valid, len(lines) - valid, toc - tic))
+    return result
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    random.seed(42)
+    lines = corpus(size)
+    print("Parsing {} generated access lines".format(size))
+    old = measure('legacy', legacy, lines)
+    new = measure('accesslog', accesslog.parseBatch, lines)
+    if old != new:
+        print("WARNING : {} lines parsed differently".format(len([1 for (a, b) in zip(old, new) if a != b])))
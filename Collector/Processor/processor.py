@@ -1,14 +1,60 @@
-import re
 import os
+import json
 import logging
+import math
+import multiprocessing
+import signal
 import sys
+import threading
 import time
+import urllib.request
+import uuid
 import mysql.connector
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+import accesslog
 
 connection = None
 log = None
 
+# number of access rows consumed per chunk in batch mode
+BATCH_SIZE = int(os.environ.get("BATCH_SIZE", 5000))
+# max entries kept by each lookup cache before evicting the least recently used
+CACHE_SIZE = int(os.environ.get("CACHE_SIZE", 10000))
+
+# daemon mode polling back-off bounds (seconds) and node discovery interval
+POLL_MIN_SLEEP = float(os.environ.get("POLL_MIN_SLEEP", 0.5))
+POLL_MAX_SLEEP = float(os.environ.get("POLL_MAX_SLEEP", 30))
+NODE_INTERVAL = float(os.environ.get("NODE_INTERVAL", 60))
+# concurrent consumers : worker processes in this pod, access rows claimed with an expiring lease
+WORKERS = int(os.environ.get("PROCESSOR_WORKERS", 1))
+CLAIM = True if os.environ.get("CLAIM") or WORKERS > 1 else False
+LEASE_TIMEOUT = int(os.environ.get("LEASE_TIMEOUT", 300))
+# maintain per minute/hour link rollups (rollup_minute, rollup_hour) with ingested requests
+ROLLUP = True if os.environ.get("ROLLUP") else False
+# log-scale latency histogram (histogram_minute, histogram_hour) kept with rollups : bin 0 holds <= 1ms,
+# each next bin is 20% wider and the last one is open, so a bucket never stores more than 64 bins per metric
+HISTOGRAM_BINS = 64
+HISTOGRAM_MIN = 0.001
+HISTOGRAM_GROWTH = 1.2
+# retention in days per storage tier (0 keeps forever), older rows are dropped by chunks of RETENTION_CHUNK
+# rollups are the downsampled tiers : raw request rows -> minute buckets -> hour buckets, so raw requests are
+# only purged with ROLLUP and once the rows written before rollups were enabled are downsampled
+RETENTION_RAW = float(os.environ.get("RETENTION_RAW", 7))
+RETENTION_MINUTE = float(os.environ.get("RETENTION_MINUTE", 30))
+RETENTION_HOUR = float(os.environ.get("RETENTION_HOUR", 365))
+RETENTION_CHUNK = int(os.environ.get("RETENTION_CHUNK", 10000))
+MAINTENANCE_INTERVAL = float(os.environ.get("MAINTENANCE_INTERVAL", 3600))
+# master registry (e.g. http://master-service.kube-sms.svc.cluster.local/registry) : when set, registrations are
+# followed through its delta endpoint and resolved locally, MySQL is only the fallback when the master is unreachable
+REGISTRY_URL = os.environ.get("REGISTRY_URL", None)
+
+caches = {'registration': OrderedDict(), 'node': OrderedDict(), 'link': OrderedDict()}
+registrationVersion = None
+registry = {'version': 0, 'registrations': {}, 'index': None}
+stopping = threading.Event()
+
 def connect():
         global connection
         if connection != None and connection.is_connected():
@@ -34,9 +80,11 @@ def run():
     if not connect():
         raise NameError('Unable to connect to database')
     
+    initBackfill()
     connection.start_transaction()
     logger().info("Start node processing...")
     processNode()
+    loadCache()
     
     cursor = connection.cursor()
     cursor.execute("SELECT * FROM access LIMIT 100")
@@ -58,19 +106,382 @@ def run():
 
     # update node state (check if exist one active service)
     stateNode()
+    maintain()
     
     toc = time.time()
     logger().info("Processor done in {} seconds.".format(round(toc -tic)))
 
+def runBatch():
+    tic = time.time()
+    global connection
+    if not connect():
+        raise NameError('Unable to connect to database')
+
+    initBackfill()
+    connection.start_transaction()
+    logger().info("Start node processing...")
+    processNode()
+    loadCache()
+
+    logger().info("Start batch request processing (chunk size {})...".format(BATCH_SIZE))
+    lastID, processed, invalid, error = 0, 0, 0, 0
+    while True:
+        refreshCache()
+        list, claim = fetchChunk(lastID)
+        if not len(list):
+            break
+        state = processChunk(list, claim)
+        processed += state[0]
+        invalid += state[1]
+        error += state[2]
+        lastID = list[-1][0]
+    logger().info("Batch request processing finished with {} processed, {} invalid and on error {}".format(processed, invalid, error))
+
+    stateNode()
+    maintain()
+
+    toc = time.time()
+    logger().info("Processor done in {} seconds.".format(round(toc -tic)))
+
+def daemon(worker = 0):
+    global connection
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    if not connect():
+        raise NameError('Unable to connect to database')
+
+    initBackfill()
+    connection.start_transaction()
+    processNode()
+    loadCache()
+    logger().info("Processor daemon started (chunk size {})...".format(BATCH_SIZE))
+
+    lastID, sleep, nodeCheck, maintenance = 0, 0, time.time(), 0
+    while not stopping.is_set():
+        tic = time.time()
+        try:
+            if not connect():
+                raise NameError('Unable to connect to database')
+            if tic - nodeCheck > NODE_INTERVAL:
+                processNode()
+                stateNode()
+                nodeCheck = tic
+            # only one worker of the pod runs retention
+            if worker == 0 and tic - maintenance > MAINTENANCE_INTERVAL:
+                maintain()
+                maintenance = tic
+            refreshCache()
+            list, claim = fetchChunk(lastID)
+            # end the read snapshot, otherwise next polls will never see new rows
+            connection.commit()
+            state = processChunk(list, claim) if len(list) else None
+        except Exception as e:
+            logger().error("Error when polling access {}".format(e))
+            connection = None
+            stopping.wait(POLL_MAX_SLEEP)
+            continue
+
+        if state:
+            toc = time.time()
+            logger().info("Iteration processed {} requests ({} invalid, {} on error) in {} seconds, {} rows/s".format(
+                state[0], state[1], state[2], round(toc - tic, 3), round(len(list) / max(toc - tic, 0.001))))
+        if len(list) >= BATCH_SIZE:
+            # backlog : loop without waiting
+            lastID, sleep = list[-1][0], 0
+        else:
+            # restart from the first id to catch rows committed out of id order
+            lastID = 0
+            sleep = POLL_MIN_SLEEP if len(list) else min(max(sleep * 2, POLL_MIN_SLEEP), POLL_MAX_SLEEP)
+            stopping.wait(sleep)
+
+    if connect():
+        stateNode()
+        connection.close()
+    logger().info("Processor daemon stopped.")
+
+def stop(signum, frame):
+    logger().info("Signal {} received, stopping after current iteration...".format(signum))
+    stopping.set()
+
+def workers():
+    global connection
+    # mark the backfill limit before any worker rolls up, children open their own connection
+    if not connect():
+        raise NameError('Unable to connect to database')
+    initBackfill()
+    connection.close()
+    connection = None
+    processes = []
+    for index in range(WORKERS):
+        process = multiprocessing.Process(target=daemon, args=(index,), name="processor-{}".format(index))
+        process.start()
+        processes.append(process)
+    logger().info("Started {} processor workers".format(WORKERS))
+
+    def forward(signum, frame):
+        for process in processes:
+            process.terminate()
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for process in processes:
+        process.join()
+    logger().info("All processor workers stopped.")
+
+def maintain():
+    # one maintenance at a time across replicas and overlapping jobs, the others skip this round
+    cursor = connection.cursor()
+    cursor.execute("SELECT GET_LOCK('sms-maintain', 0)")
+    if cursor.fetchone()[0] != 1:
+        logger().info("Maintenance already running elsewhere, skipped")
+        return {}
+    try:
+        return retain()
+    finally:
+        cursor.execute("SELECT RELEASE_LOCK('sms-maintain')")
+        cursor.fetchall()
+
+def retain():
+    tic = time.time()
+    reclaimed = {}
+    now = datetime.now()
+    if RETENTION_RAW > 0:
+        # without rollups raw rows are the only tier, never purge them
+        if ROLLUP and downsample():
+            reclaimed['request'] = purgeById('request', now - timedelta(days=RETENTION_RAW))
+        reclaimed['error'] = purgeById('error', now - timedelta(days=RETENTION_RAW))
+    if ROLLUP:
+        for (tables, days) in ((('rollup_minute', 'histogram_minute'), RETENTION_MINUTE), (('rollup_hour', 'histogram_hour'), RETENTION_HOUR)):
+            if days > 0:
+                for table in tables:
+                    reclaimed[table] = purgeByBucket(table, now - timedelta(days=days))
+    logger().info("Retention reclaimed {} rows {} in {} seconds".format(sum(reclaimed.values()), reclaimed, round(time.time() - tic, 3)))
+    return reclaimed
+
+def initBackfill():
+    # raw rows older than the rollup start (first hour bucket, or now when there is none yet) are in no bucket
+    if not ROLLUP:
+        return
+    cursor = connection.cursor()
+    cursor.execute("""INSERT IGNORE INTO rollup_backfill (id, last_id, until_id) SELECT 1, 0, COALESCE(MAX(id), 0) FROM request
+        WHERE created_at < COALESCE((SELECT MIN(bucket) FROM rollup_hour), NOW() + INTERVAL 1 DAY)""")
+    connection.commit()
+
+def downsample():
+    # roll up raw rows written before rollups by id chunks, progress commits with the buckets
+    cursor = connection.cursor()
+    rolled = 0
+    while True:
+        # progress read again under row lock in each chunk transaction
+        cursor.execute("SELECT last_id, until_id FROM rollup_backfill WHERE id = 1 FOR UPDATE")
+        row = cursor.fetchone()
+        if row == None:
+            connection.rollback()
+            return False
+        lastID, untilID = row
+        if lastID >= untilID:
+            connection.commit()
+            break
+        if stopping.is_set():
+            connection.rollback()
+            return False
+        # created_at is the time raw queries use, older at values have no known offset
+        cursor.execute("""SELECT id, link, from_id, to_id, code, created_at, request_time, response_time FROM request
+            WHERE id > %s AND id <= %s ORDER BY id LIMIT %s""", (lastID, untilID, RETENTION_CHUNK))
+        rows = cursor.fetchall()
+        lastID = rows[-1][0] if len(rows) else untilID
+        saveRollups([row[1:] for row in rows])
+        cursor.execute("UPDATE rollup_backfill SET last_id = %s WHERE id = 1", (lastID,))
+        connection.commit()
+        rolled += len(rows)
+    if rolled:
+        logger().info("Downsampled {} raw requests written before rollups".format(rolled))
+    return True
+
+def purgeById(table, before):
+    # ids grow with created_at : walk the primary key by chunks instead of scanning created_at
+    cursor = connection.cursor()
+    deleted = 0
+    while True:
+        cursor.execute("SELECT id, created_at FROM "+table+" ORDER BY id LIMIT 1 OFFSET %s", (RETENTION_CHUNK - 1,))
+        row = cursor.fetchone()
+        if row and row[1] < before:
+            cursor.execute("DELETE FROM "+table+" WHERE id <= %s", (row[0],))
+        elif row:
+            # last partial chunk
+            cursor.execute("DELETE FROM "+table+" WHERE id <= %s AND created_at < %s", (row[0], before))
+        else:
+            # less than a chunk left in the table
+            cursor.execute("DELETE FROM "+table+" WHERE created_at < %s", (before,))
+        deleted += cursor.rowcount
+        connection.commit()
+        if not row or row[1] >= before or stopping.is_set():
+            return deleted
+
+def purgeByBucket(table, before):
+    # primary key starts with bucket, each chunk is a small range delete
+    cursor = connection.cursor()
+    deleted = 0
+    while True:
+        cursor.execute("DELETE FROM "+table+" WHERE bucket < %s LIMIT %s", (before, RETENTION_CHUNK))
+        deleted += cursor.rowcount
+        connection.commit()
+        if cursor.rowcount < RETENTION_CHUNK or stopping.is_set():
+            return deleted
+
+def fetchChunk(lastID):
+    cursor = connection.cursor()
+    if not CLAIM:
+        # keyset pagination : never rescan already consumed ids
+        cursor.execute("SELECT id, host, message FROM access WHERE id > %s ORDER BY id LIMIT %s", (lastID, BATCH_SIZE))
+        return (cursor.fetchall(), None)
+    # claim free (or expired) rows for this worker, concurrent claims wait on row locks then skip claimed rows
+    claim = uuid.uuid4().hex
+    cursor.execute("UPDATE access SET claim = %s, claimed_at = NOW() WHERE claim IS NULL OR claimed_at < NOW() - INTERVAL %s SECOND ORDER BY id LIMIT %s",
+        (claim, LEASE_TIMEOUT, BATCH_SIZE))
+    connection.commit()
+    cursor.execute("SELECT id, host, message FROM access WHERE claim = %s ORDER BY id", (claim,))
+    return (cursor.fetchall(), claim)
+
+def processChunk(list, claim = None):
+    global connection
+    # one retry when InnoDB picked this chunk as a deadlock victim, then row by row
+    for attempt in range(2):
+        try:
+            requests, errors = resolveChunk(list)
+            saveChunk(requests, errors)
+            cursor = connection.cursor()
+            if claim:
+                cursor.execute("DELETE FROM access WHERE id >= %s AND id <= %s AND claim = %s", (list[0][0], list[-1][0], claim))
+                if cursor.rowcount != len(list):
+                    # lease expired and rows were claimed again, drop this work and let the new owner process them
+                    connection.rollback()
+                    logger().warning("Lease of chunk {}-{} lost ({} of {} rows still claimed), rolled back".format(list[0][0], list[-1][0], cursor.rowcount, len(list)))
+                    return (0, 0, 0)
+            else:
+                # only the ids read : rows committed inside the range after the select are left for the next poll
+                cursor.execute("DELETE FROM access WHERE id >= %s AND id <= %s AND id IN ("+','.join(['%s'] * len(list))+")",
+                    (list[0][0], list[-1][0]) + tuple([row[0] for row in list]))
+                if cursor.rowcount != len(list):
+                    # another consumer read the same rows and deleted them first, its results are the ones kept
+                    connection.rollback()
+                    logger().warning("Chunk {}-{} consumed concurrently ({} of {} rows left), rolled back".format(list[0][0], list[-1][0], cursor.rowcount, len(list)))
+                    return (0, 0, 0)
+            connection.commit()
+            break
+        except Exception as e:
+            connection.rollback()
+            if getattr(e, 'errno', None) == 1213 and attempt == 0:
+                logger().warning("Deadlock on chunk {}-{}, retrying".format(list[0][0], list[-1][0]))
+                continue
+            logger().error("Error when chunk {}-{} processing {}, fallback to row processing".format(list[0][0], list[-1][0], e))
+            return processRows(list)
+    invalid = len([1 for (row, valid) in errors if valid is False])
+    return (len(requests), invalid, len(errors) - invalid)
+
+def saveChunk(requests, errors):
+    cursor = connection.cursor()
+    if len(requests):
+        cursor.executemany("INSERT INTO request (link, from_id, to_id, code, at, request_time, response_time) VALUES (%s, %s, %s, %s, %s, %s, %s)", requests)
+    if len(errors):
+        cursor.executemany("INSERT INTO error (host, ident, message) VALUES (%s, 'processor', %s)", [(row[1], row[2]) for (row, valid) in errors])
+    saveRollups(requests)
+
+def saveRollups(requests):
+    if not ROLLUP or not len(requests):
+        return
+    minutes, hours = {}, {}
+    minuteBins, hourBins = {}, {}
+    families = {'2': 3, '3': 4, '4': 5, '5': 6}
+    for (linkID, fromID, toID, code, at, requestTime, responseTime) in requests:
+        # buckets are naive UTC like the API windows, nginx times carry the sidecar offset
+        if at.tzinfo != None:
+            at = at.astimezone(timezone.utc)
+        minute = at.replace(second=0, microsecond=0, tzinfo=None)
+        for (buckets, bins, bucket) in ((minutes, minuteBins, minute), (hours, hourBins, minute.replace(minute=0))):
+            if (bucket, linkID) not in buckets:
+                buckets[(bucket, linkID)] = [fromID, toID, 0, 0, 0, 0, 0, 0.0, 0.0]
+            rollup = buckets[(bucket, linkID)]
+            rollup[2] += 1
+            if str(code)[:1] in families:
+                rollup[families[str(code)[:1]]] += 1
+            rollup[7] += float(requestTime)
+            rollup[8] += float(responseTime)
+            for (metric, value) in ((0, requestTime), (1, responseTime)):
+                key = (bucket, linkID, fromID, toID, metric, histogramBin(float(value)))
+                bins[key] = bins.get(key, 0) + 1
+    cursor = connection.cursor()
+    for (table, buckets) in (('rollup_minute', minutes), ('rollup_hour', hours)):
+        # hour buckets are derived from the same aggregation, both commit with the consumed rows
+        # rows go in primary key order so concurrent chunks lock shared buckets in the same order
+        cursor.executemany("""INSERT INTO """+table+""" (bucket, link, from_id, to_id, count, 2xx, 3xx, 4xx, 5xx, request_time, response_time)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE count = count + VALUES(count),
+            2xx = 2xx + VALUES(2xx), 3xx = 3xx + VALUES(3xx), 4xx = 4xx + VALUES(4xx), 5xx = 5xx + VALUES(5xx),
+            request_time = request_time + VALUES(request_time), response_time = response_time + VALUES(response_time)""",
+            sorted([(bucket, linkID) + tuple(rollup) for ((bucket, linkID), rollup) in buckets.items()], key=lambda row: row[:2]))
+    for (table, bins) in (('histogram_minute', minuteBins), ('histogram_hour', hourBins)):
+        cursor.executemany("INSERT INTO "+table+" (bucket, link, from_id, to_id, metric, bin, count) VALUES (%s, %s, %s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE count = count + VALUES(count)",
+            sorted([key + (count,) for (key, count) in bins.items()], key=lambda row: (row[0], row[1], row[4], row[5])))
+
+def histogramBin(value):
+    if value <= HISTOGRAM_MIN:
+        return 0
+    return min(int(math.log(value / HISTOGRAM_MIN) / math.log(HISTOGRAM_GROWTH)) + 1, HISTOGRAM_BINS - 1)
+
+def processRows(list):
+    processed, invalid, error = 0, 0, 0
+    for value in list:
+        state = processRequest({'id': value[0], 'host': value[1], 'message': value[2]})
+        if state == True:
+            processed += 1
+        elif state == False:
+            invalid += 1
+        else:
+            error += 1
+    return (processed, invalid, error)
+
+def resolveChunk(list):
+    parsed, errors = [], []
+    for (row, groups) in zip(list, accesslog.parseBatch([row[2] for row in list])):
+        if groups:
+            parsed.append((row, groups))
+        else:
+            errors.append((row, False))
+
+    # resolve every host and remote address of the chunk at once
+    registrations = getServicesByHostOrIp(set([row[1] for (row, groups) in parsed] + [groups[0] for (row, groups) in parsed]))
+    nodes = getNodesByGroupName(set([registration['groupname'] for registration in registrations.values()]))
+    pairs = {}
+    for (row, groups) in parsed:
+        toService, fromService = registrations.get(row[1]), registrations.get(groups[0])
+        toNode = nodes.get(toService['groupname']) if toService else None
+        fromNode = nodes.get(fromService['groupname']) if fromService else None
+        if toNode:
+            pairs[(fromService['id'] if fromService else 0, toNode['id'])] = fromNode['id'] if fromNode else 0
+    links = getLinksByFromAndToID(pairs.keys())
+    for (fromID, toID) in pairs.keys():
+        if (fromID, toID) not in links:
+            links[(fromID, toID)] = {'id': createLink(pairs[(fromID, toID)], fromID, toID)}
+
+    requests = []
+    for (row, groups) in parsed:
+        try:
+            toService, fromService = registrations.get(row[1]), registrations.get(groups[0])
+            toID = nodes[toService['groupname']]['id']
+            fromID = fromService['id'] if fromService else 0 #0 if source is ingress
+            requests.append((links[(fromID, toID)]['id'], fromID, toID, groups[2], groups[1], groups[3], groups[4]))
+        except Exception as e:
+            logger().error("Error when request {} processing {}".format(row, e))
+            errors.append((row, None))
+    return (requests, errors)
+
 def processRequest(request):
     global connection
-    p = re.compile('([0-9.]+) - .* \[(.*)\] ".*" ([0-9]+) [0-9]+ ".*" ".*" - rt=([0-9\.]+) uct=[0-9\.]+ uht=[0-9\.]+ urt=([0-9\.]+)', re.IGNORECASE)
-    r = p.match(request['message']);
+    r = accesslog.parse(request['message'])
     if r:
         try:
             toNode = getNodeIDByHostOrIp(request['host'])
-            fromService = getServiceByHostOrIp(r.group(1))
-            fromNode = getNodeIDByHostOrIp(r.group(1))
+            fromService = getServiceByHostOrIp(r[0])
+            fromNode = getNodeIDByHostOrIp(r[0])
             # check if link from-to not found create if
             toID = toNode['id']
             fromID = fromService['id'] if fromService else 0 #0 if source is ingress
@@ -81,13 +492,11 @@ def processRequest(request):
             else:
                 linkID = link['id']
             # create request
-            at = datetime.strptime(r.group(2), '%d/%b/%Y:%H:%M:%S %z')
-            code = r.group(3)
-            requestTime = r.group(4)
-            responseTime = r.group(5)
+            remoteAddr, at, code, requestTime, responseTime = r
             cursor = connection.cursor()
             cursor.execute("INSERT INTO request (link, from_id, to_id, code, at, request_time, response_time) VALUES (%s, %s, %s, %s, %s, %s, %s)", 
                 (linkID, fromID, toID, code, at, requestTime, responseTime))
+            saveRollups([(linkID, fromID, toID, code, at, requestTime, responseTime)])
             cursor.execute("DELETE FROM access WHERE id = %s", (request['id'], ))
             connection.commit()
             return True
@@ -109,26 +518,78 @@ def processRequest(request):
 
 def createLink(fromNodeID, fromID, toID):
     cursor = connection.cursor()
-    cursor.execute("INSERT INTO link (from_node_id, from_id, to_id) VALUES (%s, %s, %s)", (fromNodeID, fromID,toID))
+    # unique (from_id, to_id) : a link created meanwhile by another worker gives back its id
+    cursor.execute("INSERT INTO link (from_node_id, from_id, to_id) VALUES (%s, %s, %s) ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)", (fromNodeID, fromID,toID))
     connection.commit()
-    logger().info("New link registred from Node {} to Node {}".format(fromNodeID, toID))
+    if cursor.rowcount == 1:
+        logger().info("New link registred from Node {} to Node {}".format(fromNodeID, toID))
+    cachePut('link', (fromID, toID), {'id': cursor.lastrowid, 'from_node_id': fromNodeID, 'from_id': fromID, 'to_id': toID})
     return cursor.lastrowid
 
 def getLinkByFromAndToID(fromID, toID):
+    found, link = cacheGet('link', (fromID, toID))
+    if found:
+        return link
     cursor = connection.cursor()
     cursor.execute("SELECT * FROM link WHERE from_id = %s and to_id = %s", (fromID,toID))
     link = cursor.fetchone()
     if not link:
         return None 
-    return associate(link, cursor.description)
+    link = associate(link, cursor.description)
+    cachePut('link', (fromID, toID), link)
+    return link
 
 def getServiceByHostOrIp(id):
+    found, registration = cacheGet('registration', id)
+    if found:
+        return registration
+    if registry['index'] != None:
+        registration = registry['index'].get(id)
+        cachePut('registration', id, registration)
+        return registration
     cursor = connection.cursor()
     cursor.execute("SELECT * FROM registration WHERE host LIKE %s or ip LIKE %s", (id,id))
     registration = cursor.fetchone()
-    if not registration:
-        return None 
-    return associate(registration, cursor.description)
+    if registration:
+        registration = associate(registration, cursor.description)
+    # unknown addresses (ingress) are cached too, until registration changes
+    cachePut('registration', id, registration)
+    return registration
+
+def getServicesByHostOrIp(ids):
+    services = {}
+    missing = []
+    for id in ids:
+        if not id:
+            continue
+        found, registration = cacheGet('registration', id)
+        if not found:
+            missing.append(id)
+        elif registration:
+            services[id] = registration
+    ids = missing
+    if registry['index'] != None:
+        for id in ids:
+            if id in registry['index']:
+                services[id] = registry['index'][id]
+            cachePut('registration', id, services.get(id))
+        return services
+    if not len(ids):
+        return services
+    placeholders = ','.join(['%s'] * len(ids))
+    cursor = connection.cursor()
+    # same result as getServiceByHostOrIp : first registered row wins
+    cursor.execute("SELECT * FROM registration WHERE host IN ("+placeholders+") OR ip IN ("+placeholders+") ORDER BY id", tuple(ids) + tuple(ids))
+    list = cursor.fetchall()
+    columns = cursor.description
+    for row in list:
+        registration = associate(row, columns)
+        for key in (registration['host'], registration['ip']):
+            if key in ids and key not in services:
+                services[key] = registration
+    for id in ids:
+        cachePut('registration', id, services.get(id))
+    return services
 
 def getNodeIDByHostOrIp(id):
     service = getServiceByHostOrIp(id)
@@ -139,68 +600,217 @@ def getNodeIDByHostOrIp(id):
 def processNode():
     global connection
     cursor = connection.cursor()
-    cursor.execute("SELECT * FROM registration")
+    try:
+        # groups without node, whatever the registration history size
+        cursor.execute("SELECT DISTINCT r.groupname FROM registration r LEFT JOIN node n ON n.name = r.groupname WHERE n.id IS NULL")
+        groupnames = [row[0] for row in cursor.fetchall()]
+        if len(groupnames):
+            # unique name : nodes created meanwhile by another worker are kept
+            cursor.executemany("INSERT INTO node (name, active) VALUES (%s, %s) ON DUPLICATE KEY UPDATE id = id", [(groupname, False) for groupname in groupnames])
+            connection.commit()
+            logger().info("New nodes registred {}".format(groupnames))
+            getNodesByGroupName(groupnames)
+    except Exception as e:
+        connection.rollback()
+        logger().error("Error when node processing {}".format(e))
+        return
+    logger().info("Node processing finished with {} created".format(len(groupnames)))
+
+def stateNode():
+    global connection
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT groupname, COUNT(*) FROM registration WHERE active = %s GROUP BY groupname", (True,))
+        counts = dict(cursor.fetchall())
+        cursor.execute("SELECT id, name, active FROM node")
+        changes = {True: [], False: []}
+        for (id, name, active) in cursor.fetchall():
+            # node is active if exist one active service
+            state = counts.get(name, 0) > 0
+            if state != bool(active):
+                changes[state].append((id, name))
+        for (state, nodes) in changes.items():
+            if len(nodes):
+                cursor.execute("UPDATE node SET active = %s WHERE id IN ("+','.join(['%s'] * len(nodes))+")", (state,) + tuple([id for (id, name) in nodes]))
+        connection.commit()
+    except Exception as e:
+        connection.rollback()
+        logger().error("Error when node state updating {}".format(e))
+        return
+    for (state, nodes) in changes.items():
+        for (id, name) in nodes:
+            found, cached = cacheGet('node', name)
+            if found and cached:
+                cached['active'] = state
+            logger().info("Node updated : {}".format(name))
+    logger().info("Node state updating finished with {} updated".format(len(changes[True]) + len(changes[False])))
+
+def getNodeByGroupName(groupname):
+    found, node = cacheGet('node', groupname)
+    if found:
+        return node
+    cursor = connection.cursor()
+    cursor.execute("SELECT * FROM node WHERE name LIKE %s", (groupname,))
+    node = cursor.fetchone()
+    if not node:
+        return node 
+    node = associate(node, cursor.description)
+    cachePut('node', groupname, node)
+    return node
+
+def getNodesByGroupName(groupnames):
+    nodes = {}
+    missing = []
+    for groupname in groupnames:
+        found, node = cacheGet('node', groupname)
+        if found:
+            nodes[groupname] = node
+        else:
+            missing.append(groupname)
+    if not len(missing):
+        return nodes
+    groupnames = tuple(missing)
+    cursor = connection.cursor()
+    cursor.execute("SELECT * FROM node WHERE name IN ("+','.join(['%s'] * len(groupnames))+") ORDER BY id", groupnames)
     list = cursor.fetchall()
     columns = cursor.description
-    new, error = 0, 0
     for row in list:
-        try:
-            registration = associate(row, columns)
-            node = getNodeByGroupName(registration['groupname'])
-            if not node:
-                createNode(registration)
-                new += 1
-        except Exception as e:
-            connection.rollback()
-            error += 1
-            logger().error("Error when node {} processing {}".format(registration, e))
-    logger().info("Node processing finished with {} created and on error {}".format(new, error))
+        node = associate(row, columns)
+        if node['name'] not in nodes:
+            nodes[node['name']] = node
+            cachePut('node', node['name'], node)
+    return nodes
 
-def stateNode():
-    global connection
+def getLinksByFromAndToID(pairs):
+    links = {}
+    missing = []
+    for pair in pairs:
+        found, link = cacheGet('link', pair)
+        if found:
+            links[pair] = link
+        else:
+            missing.append(pair)
+    pairs = tuple(missing)
+    if not len(pairs):
+        return links
+    params = ()
+    for pair in pairs:
+        params += pair
     cursor = connection.cursor()
-    cursor.execute("SELECT * FROM node")
+    # OR of pairs rather than a row constructor IN, MySQL 5.6 only ranges linkpairidx with the former
+    cursor.execute("SELECT * FROM link WHERE "+' OR '.join(['(from_id = %s AND to_id = %s)'] * len(pairs))+" ORDER BY id", params)
     list = cursor.fetchall()
     columns = cursor.description
-    up, error = 0, 0
     for row in list:
-        try:
-            node = associate(row, columns)
-            if updateNode(node):
-                up += 1
-        except Exception as e:
-            connection.rollback()
-            error += 1
-            logger().error("Error when node {} state updating {}".format(node, e))
-    logger().info("Node state updating finished with {} updated and on error {}".format(up, error))
+        link = associate(row, columns)
+        if (link['from_id'], link['to_id']) not in links:
+            links[(link['from_id'], link['to_id'])] = link
+            cachePut('link', (link['from_id'], link['to_id']), link)
+    return links
 
-def createNode(registration):
-    global connection
+def cacheGet(name, key):
+    cache = caches[name]
+    if key not in cache:
+        return (False, None)
+    cache.move_to_end(key)
+    return (True, cache[key])
+
+def cachePut(name, key, value):
+    cache = caches[name]
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > CACHE_SIZE:
+        cache.popitem(last=False)
+
+def loadCache():
+    global registrationVersion
+    for cache in caches.values():
+        cache.clear()
+    registrationVersion = getRegistrationVersion()
+    loadRegistrations()
     cursor = connection.cursor()
-    cursor.execute("INSERT INTO node (name, active) VALUES (%s, %s)", (registration['groupname'], False))
-    connection.commit()
-    logger().info("New node registred {}".format(registration['groupname']))
-    return cursor.lastrowid
+    cursor.execute("SELECT * FROM node ORDER BY id")
+    list = cursor.fetchall()
+    columns = cursor.description
+    for row in list:
+        node = associate(row, columns)
+        if node['name'] not in caches['node']:
+            cachePut('node', node['name'], node)
+    cursor.execute("SELECT * FROM link ORDER BY id")
+    list = cursor.fetchall()
+    columns = cursor.description
+    for row in list:
+        link = associate(row, columns)
+        if (link['from_id'], link['to_id']) not in caches['link']:
+            cachePut('link', (link['from_id'], link['to_id']), link)
+    logger().info("Cache loaded with {} registrations, {} nodes and {} links".format(len(caches['registration']), len(caches['node']), len(caches['link'])))
 
-def updateNode(node):
-    global connection
+def loadRegistrations():
+    if REGISTRY_URL and syncRegistry() != None:
+        fillRegistrations(sorted(registry['registrations'].values(), key=lambda registration: registration['id']))
+        return
+    readRegistrations()
+
+def readRegistrations():
     cursor = connection.cursor()
-    cursor.execute("SELECT COUNT(*) FROM registration WHERE active = %s AND groupname = %s", (True, node['name']))
-    count = cursor.fetchone()
-    if (count[0] > 0 and not node['active']) or (count[0] == 0 and node['active']):
-        cursor.execute("UPDATE node SET active = %s WHERE id = %s", (count[0] > 0, node['id']))
-        connection.commit()
-        logger().info("Node updated : {}".format(node['name']))
-        return True   
-    return False 
+    cursor.execute("SELECT * FROM registration ORDER BY id")
+    list = cursor.fetchall()
+    columns = cursor.description
+    fillRegistrations([associate(row, columns) for row in list])
 
-def getNodeByGroupName(groupname):
+def fillRegistrations(registrations):
+    caches['registration'].clear()
+    # first registered row wins, like getServiceByHostOrIp
+    for registration in registrations:
+        for key in (registration['host'], registration['ip']):
+            if key not in caches['registration']:
+                cachePut('registration', key, registration)
+
+def syncRegistry():
+    # local copy of the master registry, True when it changed, None when the master can't be reached
+    try:
+        with urllib.request.urlopen(REGISTRY_URL + '/changes?since=' + str(registry['version']), timeout=5) as response:
+            data = json.loads(response.read().decode('utf-8'))
+        if data['snapshot']:
+            registry['registrations'] = {}
+        for registration in data['changes']:
+            registry['registrations'][registration['id']] = registration
+    except (OSError, ValueError, KeyError) as e:
+        logger().warning("Registry sync from {} failed : {}".format(REGISTRY_URL, e))
+        registry['version'], registry['index'] = 0, None
+        return None
+    changed = data['version'] != registry['version'] or registry['index'] == None
+    registry['version'] = data['version']
+    if changed:
+        # host / ip answers, first registered row wins
+        index = {}
+        for registration in sorted(registry['registrations'].values(), key=lambda registration: registration['id']):
+            for key in (registration['host'], registration['ip']):
+                if key not in index:
+                    index[key] = registration
+        registry['index'] = index
+    return changed
+
+def refreshCache():
+    global registrationVersion
+    if REGISTRY_URL:
+        changed = syncRegistry()
+        if changed:
+            caches['registration'].clear()
+            logger().info("Registry changed (version {}), {} registrations".format(registry['version'], len(registry['registrations'])))
+        if changed != None:
+            return
+    version = getRegistrationVersion()
+    if version != registrationVersion:
+        # registrations changed (new pod or unregister), reload host/ip answers and forget unknown ones
+        readRegistrations()
+        registrationVersion = version
+        logger().info("Registration changed, cache refreshed with {} entries".format(len(caches['registration'])))
+
+def getRegistrationVersion():
     cursor = connection.cursor()
-    cursor.execute("SELECT * FROM node WHERE name LIKE %s", (groupname,))
-    node = cursor.fetchone()
-    if not node:
-        return node 
-    return associate(node, cursor.description)
+    cursor.execute("SELECT COUNT(*), MAX(id), MAX(updated_at) FROM registration")
+    return cursor.fetchone()
 
 def associate(data, columns):
     row = {}
@@ -221,4 +831,11 @@ def logger():
     return log
 
 if __name__ == '__main__':
-    run()
+    if os.environ.get("PROCESSOR_MODE") == "batch":
+        runBatch()
+    elif os.environ.get("PROCESSOR_MODE") == "daemon" and WORKERS > 1:
+        workers()
+    elif os.environ.get("PROCESSOR_MODE") == "daemon":
+        daemon()
+    else:
+        run()
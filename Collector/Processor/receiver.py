@@ -0,0 +1,118 @@
+import asyncio
+import os
+import re
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import processor
+from processor import logger
+
+PORT = int(os.environ.get("RECEIVER_PORT", 5140))
+# bounded queue between the socket and the writer, datagrams are dropped (and counted) when full
+QUEUE_SIZE = int(os.environ.get("QUEUE_SIZE", 100000))
+# micro-batch written when FLUSH_SIZE lines are queued or FLUSH_INTERVAL seconds elapsed
+FLUSH_SIZE = int(os.environ.get("FLUSH_SIZE", processor.BATCH_SIZE))
+FLUSH_INTERVAL = float(os.environ.get("FLUSH_INTERVAL", 1))
+STATS_INTERVAL = float(os.environ.get("STATS_INTERVAL", 60))
+
+# RFC 3164 datagram as sent by nginx : <PRI>Mmm dd hh:mm:ss HOSTNAME TAG: MESSAGE
+SYSLOG = re.compile(r'<([0-9]{1,3})>[A-Z][a-z]{2} [ 0-9][0-9] [0-9:]{8} ([^ ]+) ([^: ]+): ?(.*)', re.DOTALL)
+# sidecar access_log uses local7, error_log local6
+ACCESS_FACILITY = 23
+
+stats = {'received': 0, 'dropped': 0, 'invalid': 0, 'written': 0, 'errors': 0, 'lost': 0, 'flushes': 0}
+queue = None
+nodeCheck = 0
+
+class SyslogProtocol(asyncio.DatagramProtocol):
+    def datagram_received(self, data, addr):
+        stats['received'] += 1
+        try:
+            queue.put_nowait(data)
+        except asyncio.QueueFull:
+            stats['dropped'] += 1
+
+def flush(batch):
+    global nodeCheck
+    rows, failures = [], []
+    for data in batch:
+        r = SYSLOG.match(data.decode('utf-8', 'replace'))
+        if not r:
+            stats['invalid'] += 1
+        elif int(r.group(1)) >> 3 == ACCESS_FACILITY:
+            rows.append((None, r.group(2), r.group(4)))
+        else:
+            failures.append((r.group(2), r.group(3), r.group(4)))
+    try:
+        if not processor.connect():
+            raise NameError('Unable to connect to database')
+        if not nodeCheck:
+            processor.processNode()
+            processor.loadCache()
+            nodeCheck = time.time()
+        elif time.time() - nodeCheck > processor.NODE_INTERVAL:
+            processor.processNode()
+            processor.stateNode()
+            nodeCheck = time.time()
+        processor.refreshCache()
+        requests, errors = processor.resolveChunk(rows)
+        processor.saveChunk(requests, errors)
+        if len(failures):
+            processor.connection.cursor().executemany("INSERT INTO error (host, ident, message) VALUES (%s, %s, %s)", failures)
+        processor.connection.commit()
+    except Exception as e:
+        logger().error("Error when writing {} received lines {}".format(len(batch), e))
+        stats['lost'] += len(rows) + len(failures)
+        processor.connection = None
+        return
+    stats['written'] += len(requests)
+    stats['errors'] += len(errors) + len(failures)
+    stats['flushes'] += 1
+
+async def writer(executor, stopping):
+    loop = asyncio.get_running_loop()
+    while not (stopping.is_set() and queue.empty()):
+        batch = []
+        deadline = loop.time() + FLUSH_INTERVAL
+        while len(batch) < FLUSH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        if len(batch):
+            # mysql.connector is blocking : write on the single executor thread, keep receiving meanwhile
+            await loop.run_in_executor(executor, flush, batch)
+
+async def reporter():
+    while True:
+        await asyncio.sleep(STATS_INTERVAL)
+        logger().info("Receiver stats {}, queued {}".format(stats, queue.qsize()))
+
+async def serve():
+    global queue
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    stopping = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stopping.set)
+    loop.add_signal_handler(signal.SIGINT, stopping.set)
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    transport, protocol = await loop.create_datagram_endpoint(SyslogProtocol, local_addr=('0.0.0.0', PORT))
+    logger().info("Receiver listening on udp/{} (queue {}, flush {} lines or {} seconds)".format(PORT, QUEUE_SIZE, FLUSH_SIZE, FLUSH_INTERVAL))
+    task = asyncio.ensure_future(writer(executor, stopping))
+    report = asyncio.ensure_future(reporter())
+
+    await stopping.wait()
+    # stop receiving, then drain what is already queued
+    transport.close()
+    await task
+    report.cancel()
+    executor.shutdown()
+    logger().info("Receiver stopped with stats {}".format(stats))
+
+if __name__ == '__main__':
+    asyncio.run(serve())
@@ -0,0 +1,25 @@
+import random
+import socket
+import sys
+import time
+from datetime import datetime
+
+# Stand-in for sidecars : send nginx-like syslog datagrams to a receiver
+# usage : python sender.py [host] [port] [count] [hostname]
+
+def line(hostname):
+    message = '10.0.{}.{} - - [{}] "GET /products HTTP/1.1" {} {} "-" "curl/7.64.0" - rt={:.3f} uct=0.001 uht={:.3f} urt={:.3f}'.format(
+        random.randint(0, 255), random.randint(1, 254), datetime.now().astimezone().strftime('%d/%b/%Y:%H:%M:%S %z'),
+        random.choice([200, 200, 200, 404, 500]), random.randint(0, 5000), random.random(), random.random() / 10, random.random())
+    return '<190>{} {} system: {}'.format(time.strftime('%b %d %H:%M:%S'), hostname, message)
+
+if __name__ == '__main__':
+    host = sys.argv[1] if len(sys.argv) > 1 else '127.0.0.1'
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 5140
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    hostname = sys.argv[4] if len(sys.argv) > 4 else socket.gethostname()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    tic = time.time()
+    for index in range(count):
+        sock.sendto(line(hostname).encode('utf-8'), (host, port))
+    print("{} datagrams sent to {}:{} in {} seconds".format(count, host, port, round(time.time() - tic, 3)))
@@ -5,7 +5,10 @@ import logging
 import sys
 import json
 import base64
+import copy
 import os
+import threading
+import time
 
 import annotations
 
@@ -28,14 +31,86 @@ api_core = client.CoreV1Api()
 
 smsGroups = {}
 
+PROXY_CONFIG_MAP = "sms-files"
+# watched services and proxy config maps, keyed by namespace/name and fully relisted every RESYNC seconds
+RESYNC = int(os.environ.get("RESYNC", 300))
+caches = {'service': {}, 'configmap': {}}
+cacheLock = threading.Lock()
+cacheSynced = {'service': threading.Event(), 'configmap': threading.Event()}
+
+# server side filter of watched deployments, e.g. LABEL_SELECTOR=medinvention.dev/sms=enabled, empty for all
+LABEL_SELECTOR = os.environ.get("LABEL_SELECTOR", "")
+FIELD_SELECTOR = os.environ.get("FIELD_SELECTOR", "")
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", 500))
+WATCH_TIMEOUT = int(os.environ.get("WATCH_TIMEOUT", 300))
+
 def loop():
   log.info("Controller started...")
+  startCaches()
+  resourceVersion = None
   try:
-    for event in w.stream(api_instance.list_deployment_for_all_namespaces, _request_timeout=0):
-      process(event['type'], event['object'])
+    while True:
+      if resourceVersion == None:
+        resourceVersion = relist()
+      resourceVersion = watchDeployments(resourceVersion)
   except KeyboardInterrupt as e:
     log.info("Controller shutdown.")
 
+"""
+Watch deployments from a resource version, return the last one seen or None when it expired
+"""
+def watchDeployments(resourceVersion):
+  try:
+    for event in w.stream(api_instance.list_deployment_for_all_namespaces, resource_version=resourceVersion, allow_watch_bookmarks=True,
+                          label_selector=LABEL_SELECTOR, field_selector=FIELD_SELECTOR, timeout_seconds=WATCH_TIMEOUT, _request_timeout=0):
+      if event['type'] == 'ERROR':
+        if event['raw_object'].get('code') == 410:
+          log.info("Watch version {} expired, relisting".format(resourceVersion))
+          return None
+        log.error("Watch error: {}".format(event['raw_object'].get('message')))
+        # back off as on exceptions, a persistent error would otherwise loop against the API server
+        time.sleep(5)
+        break
+      # bookmarks only move the version forward, nothing to process
+      if event['type'] != 'BOOKMARK':
+        process(event['type'], event['object'])
+      # moved once processed, an event whose processing raised is delivered again on resume
+      resourceVersion = event['object'].metadata.resource_version
+  except ApiException as e:
+    if e.status == 410:
+      log.info("Watch version {} expired, relisting".format(resourceVersion))
+      return None
+    log.error("Exception when watching deployments: {}".format(e))
+    time.sleep(5)
+  except Exception as e:
+    # dropped connection, resume from the last version seen
+    log.error("Watch interrupted: {}".format(e))
+    time.sleep(1)
+  return resourceVersion
+
+"""
+List deployments page by page and process each one, return the list resource version
+"""
+def relist():
+  token = None
+  while True:
+    try:
+      result = api_instance.list_deployment_for_all_namespaces(label_selector=LABEL_SELECTOR, field_selector=FIELD_SELECTOR, limit=PAGE_SIZE, _continue=token)
+    except ApiException as e:
+      if e.status == 410 and token != None:
+        # continue token expired between two pages, start over
+        token = None
+        continue
+      log.error("Exception when listing deployments: {}".format(e))
+      time.sleep(5)
+      continue
+    for deployment in result.items:
+      process("ADDED", deployment)
+    token = result.metadata._continue
+    if not token:
+      log.info("Deployments listed at version {}".format(result.metadata.resource_version))
+      return result.metadata.resource_version
+
 
 
 def process(event, deployment):
@@ -159,17 +234,11 @@ def injectSidecar(deployment, group, port, service, serviceNamespace, revision =
 Update service to change target port 
 """
 def upService(service, namespace, port, deployment, isPatching):
-  serviceList = []
-  try:
-    serviceList = api_core.list_namespaced_service(namespace, field_selector="metadata.name="+service).items
-  except ApiException as e:
-    log.error("Exception when getting list of Service: {}".format(e))
-
-  if len(serviceList) !=  1:
+  serviceData = getService(service, namespace)
+  if serviceData == None:
     log.error("Target service {} not found in namespace {}".format(service, namespace))
     return False
   
-  serviceData = serviceList[0]
   up = False
 
   targetPort = str(port)
@@ -190,8 +259,10 @@ def upService(service, namespace, port, deployment, isPatching):
   serviceData.metadata.annotations[annotations.PORT] = str(port)
   serviceData.metadata.annotations[annotations.PROXYPORT] = str(proxyPort)
 
+  # the cached version may lag an external edit, it must not be sent as a precondition
+  serviceData.metadata.resource_version = None
   try:
-    api_core.patch_namespaced_service(name=service, body=serviceData, namespace=namespace)
+    cachePut('service', api_core.patch_namespaced_service(name=service, body=serviceData, namespace=namespace))
     log.info("Patch Service {}".format(service))
   except ApiException as e:
     log.error("Exception when Patching service: {}".format(e))
@@ -202,17 +273,11 @@ def upService(service, namespace, port, deployment, isPatching):
 Reverse service to restore target port 
 """
 def reverseService(service, namespace, port):
-  serviceList = []
-  try:
-    serviceList = api_core.list_namespaced_service(namespace, field_selector="metadata.name="+service).items
-  except ApiException as e:
-    log.error("Exception when getting list of Service: {}".format(e))
-
-  if len(serviceList) !=  1:
+  serviceData = getService(service, namespace)
+  if serviceData == None:
     log.error("Target service {} not found in namespace {}".format(service, namespace))
     return False
   
-  serviceData = serviceList[0]
   up = False
 
   if not annotations.DEPLOYMENT in serviceData.metadata.annotations or not annotations.PORT in serviceData.metadata.annotations:
@@ -232,14 +297,91 @@ def reverseService(service, namespace, port):
   del serviceData.metadata.annotations[annotations.PORT]
   del serviceData.metadata.annotations[annotations.PROXYPORT]
 
+  # the cached version may lag an external edit, it must not be sent as a precondition
+  serviceData.metadata.resource_version = None
   try:
-    api_core.patch_namespaced_service(name=service, body=serviceData, namespace=namespace)
+    cachePut('service', api_core.patch_namespaced_service(name=service, body=serviceData, namespace=namespace))
     log.info("Patch Service {}".format(service))
   except ApiException as e:
     log.error("Exception when Patching service: {}".format(e))
     return False
   return True
 
+"""
+Start cache watchers and wait for their first list
+"""
+def startCaches():
+  for kind in caches:
+    threading.Thread(target=watchCache, args=(kind,), daemon=True).start()
+  for kind in caches:
+    cacheSynced[kind].wait()
+  log.info("Caches synced with {} services and {} config maps".format(len(caches['service']), len(caches['configmap'])))
+
+"""
+List then watch one kind of object into its cache, relist on resync or error
+"""
+def watchCache(kind):
+  if kind == 'service':
+    lister, selector = api_core.list_service_for_all_namespaces, {}
+  else:
+    lister, selector = api_core.list_config_map_for_all_namespaces, {'field_selector': "metadata.name="+PROXY_CONFIG_MAP}
+  watcher = watch.Watch()
+  while True:
+    try:
+      result = lister(**selector)
+      items = {}
+      for item in result.items:
+        items[cacheKey(item)] = item
+      # replaced as a whole, objects deleted while not watching are dropped
+      with cacheLock:
+        caches[kind] = items
+      cacheSynced[kind].set()
+      for event in watcher.stream(lister, resource_version=result.metadata.resource_version, timeout_seconds=RESYNC, **selector):
+        if event['type'] == 'ERROR':
+          break
+        if event['type'] == 'DELETED':
+          cacheRemove(kind, event['object'])
+        else:
+          cachePut(kind, event['object'])
+    except Exception as e:
+      log.error("Exception when watching {} cache: {}".format(kind, e))
+      time.sleep(5)
+
+def cacheKey(item):
+  return item.metadata.namespace + '/' + item.metadata.name
+
+def cachePut(kind, item):
+  with cacheLock:
+    caches[kind][cacheKey(item)] = item
+
+def cacheRemove(kind, item):
+  with cacheLock:
+    caches[kind].pop(cacheKey(item), None)
+
+"""
+Get a copy of a cached object, safe to modify before patching
+"""
+def cacheGet(kind, name, namespace):
+  with cacheLock:
+    item = caches[kind].get(namespace + '/' + name)
+  return copy.deepcopy(item) if item != None else None
+
+"""
+Get service from cache, or from the API server when created after the last watch event
+"""
+def getService(name, namespace):
+  service = cacheGet('service', name, namespace)
+  if service != None:
+    return service
+  try:
+    service = api_core.read_namespaced_service(name, namespace)
+  except ApiException as e:
+    if e.status != 404:
+      log.error("Exception when getting Service: {}".format(e))
+    return None
+  cachePut('service', service)
+  return copy.deepcopy(service)
+
 """ 
 Generate metadata for deployment 
 """
@@ -264,12 +406,8 @@ def getSideCarPort(deployment):
 Create or get a config map defining proxy config file 
 """
 def setProxyConfigMap(name, namespace, filename, port, proxyPort):
-  proxyConfigMapName = "sms-files"
-  configMaps = []
-  try:
-    configMaps = api_core.list_namespaced_config_map(namespace, field_selector="metadata.name="+proxyConfigMapName).items
-  except ApiException as e:
-    log.error("Exception when getting list of Config Map: {}".format(e))
+  proxyConfigMapName = PROXY_CONFIG_MAP
+  syslogServer = os.environ.get("SYSLOG_SERVER") if os.environ.get("SYSLOG_SERVER") else "fluentd-service.kube-sms.svc.cluster.local:5140"
 
   configMap = {
         "apiVersion": "v1",
@@ -292,8 +430,8 @@ def setProxyConfigMap(name, namespace, filename, port, proxyPort):
                     proxy_set_header X-Real-IP $remote_addr;
                     proxy_pass http://localhost:"""+str(port)+""";
                 }
-                error_log  syslog:server=fluentd-service.kube-sms.svc.cluster.local:5140,facility=local6,tag=system,severity=debug info;
-                access_log syslog:server=fluentd-service.kube-sms.svc.cluster.local:5140,facility=local7,tag=system,severity=info info;
+                error_log  syslog:server="""+syslogServer+""",facility=local6,tag=system,severity=debug info;
+                access_log syslog:server="""+syslogServer+""",facility=local7,tag=system,severity=info info;
               }
             """,
             "register": """
@@ -309,12 +447,19 @@ def setProxyConfigMap(name, namespace, filename, port, proxyPort):
             }
     }
   try:
-    if len(configMaps) ==  1:
-      api_core.patch_namespaced_config_map(name=proxyConfigMapName, body=configMap, namespace=namespace)
+    if cacheGet('configmap', proxyConfigMapName, namespace) != None:
+      cachePut('configmap', api_core.patch_namespaced_config_map(name=proxyConfigMapName, body=configMap, namespace=namespace))
       log.info("Patch Proxy Config Map {}".format(proxyConfigMapName))
     else:
-      api_core.create_namespaced_config_map(body=configMap, namespace=namespace)
-      log.info("Create Proxy Config Map {}".format(proxyConfigMapName))
+      try:
+        cachePut('configmap', api_core.create_namespaced_config_map(body=configMap, namespace=namespace))
+        log.info("Create Proxy Config Map {}".format(proxyConfigMapName))
+      except ApiException as e:
+        # created after the last watch event
+        if e.status != 409:
+          raise
+        cachePut('configmap', api_core.patch_namespaced_config_map(name=proxyConfigMapName, body=configMap, namespace=namespace))
+        log.info("Patch Proxy Config Map {}".format(proxyConfigMapName))
   except ApiException as e:
     log.error("Exception when making Proxy Config Map: {}".format(e))
     return False
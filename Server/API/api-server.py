@@ -1,14 +1,24 @@
-from flask import Flask, json, request
+from flask import Flask, Response, json, request, g
 from flask_jwt_extended import (
     JWTManager, jwt_required, create_access_token,
     jwt_refresh_token_required, create_refresh_token,
-    get_jwt_identity
+    get_jwt_identity, decode_token, verify_jwt_in_request
 )
 from flask_cors import CORS, cross_origin
 from werkzeug.security import safe_str_cmp
 from mysql.connector import Error
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 import mysql.connector
+import encoding
+import hashlib
+import math
 import os
+import queue
+import threading
+import time
 
 if not os.environ.get("USERNAME") or not os.environ.get("PASSWORD"):
     raise RuntimeError('Username and password environment variables must be defined for security access')
@@ -20,6 +30,62 @@ api.config['CORS_HEADERS'] = 'Content-Type'
 cors = CORS(api)
 jwt = JWTManager(api)
 
+# answer metrics from processor rollups (rollup_minute, rollup_hour) instead of raw request rows
+ROLLUP = True if os.environ.get("ROLLUP") else False
+# latency histogram bins, same as the processor : bin 0 holds <= 1ms, each next bin is 20% wider
+HISTOGRAM_BINS = 64
+HISTOGRAM_MIN = 0.001
+HISTOGRAM_GROWTH = 1.2
+
+# bounded MySQL connection pool : at most POOL_SIZE connections, a request waits POOL_WAIT seconds for a free one
+POOL_SIZE = int(os.environ.get("POOL_SIZE", 10))
+POOL_WAIT = float(os.environ.get("POOL_WAIT", 5))
+
+pool = queue.LifoQueue()
+poolLock = threading.Lock()
+poolStats = {'size': 0, 'in_use': 0, 'checkouts': 0, 'waits': 0, 'timeouts': 0, 'errors': 0,
+    'wait_time': 0.0, 'max_wait_time': 0.0, 'checkout_time': 0.0, 'max_checkout_time': 0.0}
+checkouts = {}
+
+# independent /get queries run concurrently on FANOUT threads (each with a pooled connection), 0 runs them in sequence
+FANOUT = int(os.environ.get("FANOUT", POOL_SIZE))
+
+executor = ThreadPoolExecutor(FANOUT) if FANOUT > 0 else None
+
+# queries slower than SLOW_QUERY_MS are logged, durations go to Server-Timing and /metrics histograms
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 500))
+METRICS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+metrics = {'request': {}, 'query': {}}
+metricsLock = threading.Lock()
+
+# /get response cache : CACHE_SIZE entries (LRU), each kept at most CACHE_TTL seconds and dropped as soon as data version moves
+CACHE_SIZE = int(os.environ.get("CACHE_SIZE", 128))
+CACHE_TTL = float(os.environ.get("CACHE_TTL", 30))
+
+cache = OrderedDict()
+cacheLock = threading.Lock()
+cacheStats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'not_modified': 0, 'evictions': 0}
+inflight = {}
+
+# /stream : one ticker per (from, to, namespace) every STREAM_INTERVAL seconds, STREAM_QUEUE pending events per subscriber
+STREAM_INTERVAL = float(os.environ.get("STREAM_INTERVAL", 5))
+STREAM_QUEUE = int(os.environ.get("STREAM_QUEUE", 16))
+STREAM_KEEPALIVE = 15
+# an open stream holds a server thread, past STREAM_MAX per process new ones get a 503 : by default every
+# gunicorn thread (THREADS) but 8 left for the other endpoints
+STREAM_MAX = int(os.environ.get("STREAM_MAX", max(int(os.environ.get("THREADS", 32)) - 8, 1)))
+
+# /get?around= : deepest neighbourhood accepted in hops
+MAX_HOPS = 10
+
+# /series : at most SERIES_POINTS buckets, resolution (seconds) picked from SERIES_RESOLUTIONS to fit the window
+SERIES_POINTS = int(os.environ.get("SERIES_POINTS", 120))
+SERIES_RESOLUTIONS = [10, 30, 60, 300, 900, 1800, 3600, 10800, 21600, 43200, 86400, 604800]
+
+streams = {}
+streamLock = threading.Lock()
+
 @cross_origin()
 @api.route('/get', methods=['OPTIONS'])
 def authOption():
@@ -65,206 +131,757 @@ def get():
     fromDate = request.args.get('from', None)
     toDate = request.args.get('to', None)
     filtredNamespace = request.args.get('namespace', None)
+    options = getGraphOptions(request.args)
+    if options == None:
+        return json.dumps({"status": False, "message": "Invalid top, limit, sort, around or hops parameter"}), 400
+    format = encoding.getFormat(request.args, request.accept_mimetypes)
+    if format == None:
+        return json.dumps({"status": False, "message": "Unsupported format"}), 400
+    contentEncoding = encoding.getContentEncoding(request.accept_encodings)
 
-    data = {'ingress': False, 'nodes': [], 'links': [], 'from': fromDate, 'to': toDate, 'namespace': filtredNamespace}
+    entry = getCachedGraph(fromDate, toDate, filtredNamespace, options)
+    if entry == None:
+        return json.dumps({"status": False, "message": "Unable to connect to master db"})
+    # each representation (format, compression) has its own tag and is encoded once per cache entry
+    with timed('encode'):
+        (body, contentEncoding) = getVariant(entry, format, contentEncoding)
+    etag = entry['etag'] + ('-' + format if format != 'json' else '') + ('-' + contentEncoding if contentEncoding else '')
+    headers = encoding.getHeaders(format, contentEncoding)
+    headers['ETag'] = '"' + etag + '"'
+    headers['Cache-Control'] = 'no-cache'
+    if request.if_none_match.contains_weak(etag):
+        with cacheLock:
+            cacheStats['not_modified'] += 1
+        return '', 304, {'ETag': headers['ETag'], 'Cache-Control': headers['Cache-Control'], 'Vary': headers['Vary']}
+    return body, 200, headers
+
+@cross_origin()
+@api.route('/stream', methods=['OPTIONS'])
+def streamOption():
+    return 'OPTIONS'
+
+@cross_origin()
+@api.route('/stream', methods=['GET'])
+def stream():
+    # EventSource can't set headers, the access token may come as ?jwt= on this endpoint only
+    if 'jwt' in request.args:
+        try:
+            claims = decode_token(request.args['jwt'])
+        except Exception as e:
+            return json.dumps({"msg": "Invalid token"}), 401
+        if claims.get('type') != 'access':
+            return json.dumps({"msg": "Only access tokens are allowed"}), 401
+    else:
+        verify_jwt_in_request()
+    options = getGraphOptions(request.args)
+    if options == None:
+        return json.dumps({"status": False, "message": "Invalid top, limit, sort, around or hops parameter"}), 400
+    key = (request.args.get('from', None), request.args.get('to', None), request.args.get('namespace', None), tuple(sorted(options.items())))
+    subscriber = subscribe(key)
+    if subscriber == None:
+        return json.dumps({"status": False, "message": "Too many open streams"}), 503, {'Retry-After': str(int(STREAM_INTERVAL))}
+
+    def events():
+        try:
+            while True:
+                try:
+                    yield subscriber.get(timeout=STREAM_KEEPALIVE)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+        finally:
+            unsubscribe(key, subscriber)
+
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@api.route('/stats', methods=['GET'])
+def stats():
+    return json.dumps({'pool': getPoolStats(), 'cache': getCacheStats()})
+
+@api.route('/metrics', methods=['GET'])
+def prometheus():
+    return getMetrics(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
 
+@api.before_request
+def start():
+    g.start = time.time()
+    g.timings = []
+
+@api.after_request
+def instrument(response):
+    if 'start' in g:
+        duration = time.time() - g.start
+        observe('request', request.endpoint or 'unknown', duration)
+        timings = g.timings + [('total', duration, None)]
+        response.headers['Server-Timing'] = ', '.join([name + ';dur=' + str(round(1000 * duration, 1)) + (';desc="' + str(rows) + ' rows"' if rows != None else '')
+            for (name, duration, rows) in timings])
+    return response
+
+def getCachedGraph(fromDate, toDate, filtredNamespace, options=None):
+    options = options or {}
+    key = (fromDate or '', toDate or '', filtredNamespace or '', tuple(sorted(options.items())))
+    version = getDataVersion()
+    if version == None:
+        return None
+    while True:
+        with cacheLock:
+            entry = cache.get(key)
+            if entry != None and entry['version'] == version and entry['expires'] > time.time():
+                cache.move_to_end(key)
+                cacheStats['hits'] += 1
+                return entry
+            # identical concurrent requests wait for the one already computing
+            flight = inflight.get((key, version))
+            if flight == None:
+                flight = inflight[(key, version)] = threading.Event()
+                cacheStats['misses'] += 1
+                break
+            cacheStats['coalesced'] += 1
+        flight.wait()
+        with cacheLock:
+            entry = cache.get(key)
+            if entry != None and entry['version'] == version:
+                return entry
+        # computation failed, try on our own
+
+    try:
+        with timed('graph'):
+            data = getGraph(fromDate, toDate, filtredNamespace, options)
+        if data == None:
+            return None
+        with timed('serialize'):
+            body = json.dumps(data)
+        entry = {'version': version, 'expires': time.time() + CACHE_TTL, 'data': data, 'body': body, 'variants': {},
+            'etag': hashlib.sha1(body.encode('utf-8')).hexdigest()}
+        with cacheLock:
+            cache[key] = entry
+            cache.move_to_end(key)
+            while len(cache) > CACHE_SIZE:
+                cache.popitem(last=False)
+                cacheStats['evictions'] += 1
+        return entry
+    finally:
+        with cacheLock:
+            inflight.pop((key, version), None)
+        flight.set()
+
+def getVariant(entry, format, contentEncoding):
+    key = (format, contentEncoding)
+    if key not in entry['variants']:
+        body = entry['body'].encode('utf-8') if format == 'json' else encoding.serialize(entry['data'], format)
+        entry['variants'][key] = encoding.compress(body, contentEncoding)
+    return entry['variants'][key]
+
+def getDataVersion():
+    # cheap probe : last processed request and registration / node changes
     db = connect()
     if db == None:
+        return None
+    cursor = db.cursor()
+    version = execute(cursor, 'version', """SELECT (SELECT MAX(id) FROM request), 
+        (SELECT CONCAT(COUNT(*), '-', MAX(id), '-', MAX(updated_at)) FROM registration), 
+        (SELECT CONCAT(COUNT(*), '-', SUM(active)) FROM node)""")[0]
+    # back to the pool (which closes the read snapshot) before waiting on a flight or computing the graph,
+    # the graph takes a connection again when it needs one
+    disconnect()
+    return tuple(map(str, version))
+
+def getCacheStats():
+    with cacheLock:
+        stats = dict(cacheStats)
+        stats['size'] = len(cache)
+    stats['limit'] = CACHE_SIZE
+    stats['ttl'] = CACHE_TTL
+    return stats
+
+def subscribe(key):
+    subscriber = queue.Queue(STREAM_QUEUE)
+    with streamLock:
+        if sum([len(stream['subscribers']) for stream in streams.values()]) >= STREAM_MAX:
+            return None
+        if key not in streams:
+            streams[key] = {'subscribers': set(), 'graph': None, 'etag': None}
+            threading.Thread(target=streamTicker, args=(key, streams[key]), daemon=True).start()
+        streams[key]['subscribers'].add(subscriber)
+        # late subscribers start from the last published graph, the first ones get it on first tick
+        if streams[key]['graph'] != None:
+            subscriber.put(getEvent('snapshot', streams[key]['graph']))
+    return subscriber
+
+def unsubscribe(key, subscriber):
+    with streamLock:
+        if key in streams:
+            streams[key]['subscribers'].discard(subscriber)
+
+def streamTicker(key, stream):
+    # graph and delta are computed once per tick whatever the subscriber count
+    while True:
+        with api.app_context():
+            entry = getCachedGraph(key[0], key[1], key[2], dict(key[3]))
+        with streamLock:
+            if not stream['subscribers']:
+                streams.pop(key, None)
+                return
+            if entry == None:
+                publish(stream, getEvent('error', {"status": False, "message": "Unable to connect to master db"}), stream['graph'])
+            elif stream['graph'] == None:
+                publish(stream, getEvent('snapshot', entry['data']), entry['data'])
+            elif entry['etag'] != stream['etag']:
+                delta = getGraphDelta(stream['graph'], entry['data'])
+                if delta:
+                    publish(stream, getEvent('delta', delta), entry['data'])
+            if entry != None:
+                stream['graph'], stream['etag'] = entry['data'], entry['etag']
+        time.sleep(STREAM_INTERVAL)
+
+def publish(stream, event, graph):
+    for subscriber in stream['subscribers']:
+        try:
+            subscriber.put_nowait(event)
+        except queue.Full:
+            # too slow to follow deltas, start over from a snapshot of the graph this event leads to
+            while not subscriber.empty():
+                subscriber.get_nowait()
+            if graph != None:
+                subscriber.put_nowait(getEvent('snapshot', graph))
+
+def getEvent(name, data):
+    return 'event: ' + name + '\ndata: ' + json.dumps(data) + '\n\n'
+
+def getGraphDelta(previous, current):
+    delta = {}
+    if previous['ingress'] != current['ingress']:
+        delta['ingress'] = current['ingress']
+
+    previousNodes = {node['id']: node for node in previous['nodes']}
+    currentNodes = {node['id']: node for node in current['nodes']}
+    added = [node for (id, node) in currentNodes.items() if id not in previousNodes]
+    removed = [id for id in previousNodes if id not in currentNodes]
+    changed = []
+    for (id, node) in currentNodes.items():
+        if id in previousNodes:
+            # only changed fields (trafic, status, disabled, services...)
+            fields = {name: value for (name, value) in node.items() if previousNodes[id].get(name) != value}
+            if fields:
+                fields['id'] = id
+                changed.append(fields)
+    if added or removed or changed:
+        delta['nodes'] = {'added': added, 'removed': removed, 'changed': changed}
+
+    previousLinks = {link['from']+'>'+link['to']: link for link in previous['links']}
+    currentLinks = {link['from']+'>'+link['to']: link for link in current['links']}
+    added = [link for (id, link) in currentLinks.items() if id not in previousLinks]
+    removed = [{'from': link['from'], 'to': link['to']} for (id, link) in previousLinks.items() if id not in currentLinks]
+    changed = []
+    for (id, link) in currentLinks.items():
+        if id in previousLinks:
+            fields = {name: value for (name, value) in link.items() if previousLinks[id].get(name) != value}
+            if fields:
+                fields['from'], fields['to'] = link['from'], link['to']
+                changed.append(fields)
+    if added or removed or changed:
+        delta['links'] = {'added': added, 'removed': removed, 'changed': changed}
+    return delta
+
+@cross_origin()
+@api.route('/series', methods=['OPTIONS'])
+def seriesOption():
+    return 'OPTIONS'
+
+@cross_origin()
+@api.route('/series', methods=['GET'])
+@jwt_required
+def series():
+    node = request.args.get('node', None)
+    link = request.args.get('link', None)
+    direction = request.args.get('direction', 'in')
+    if (node == None) == (link == None) or not (node or link).isdigit() or direction not in ('in', 'out'):
+        return json.dumps({"status": False, "message": "One numeric node or link parameter is required, direction is in or out"}), 400
+    start, end = parseDate(request.args.get('from', None)), parseDate(request.args.get('to', None))
+    resolution = request.args.get('resolution', None)
+    format = encoding.getFormat(request.args, request.accept_mimetypes)
+    if format == None:
+        return json.dumps({"status": False, "message": "Unsupported format"}), 400
+    if start == False or end == False or (start and end and start >= end) or (resolution != None and not resolution.isdigit()):
+        return json.dumps({"status": False, "message": "Invalid from, to or resolution parameter"}), 400
+
+    data = getSeries(int(node) if node else None, int(link) if link else None, direction, start, end, int(resolution) if resolution else 0)
+    if data == None:
         return json.dumps({"status": False, "message": "Unable to connect to master db"})
-        
+    (body, contentEncoding) = encoding.encode(data, format, encoding.getContentEncoding(request.accept_encodings))
+    return body, 200, encoding.getHeaders(format, contentEncoding)
+
+def getSeries(node, link, direction, start, end, resolution):
+    db = connect()
+    if db == None:
+        return None
     cursor = db.cursor()
-    cursor.execute("SELECT * FROM node")
-    list = cursor.fetchall()
+    if end == None:
+        end = execute(cursor, 'now', "SELECT NOW()")[0][0]
+    if start == None:
+        start = end - timedelta(hours=1)
+
+    resolution = getSeriesResolution(start, end, resolution)
+    # buckets are aligned on the resolution, at most SERIES_POINTS of them ending with the window
+    epoch = datetime(1970, 1, 1)
+    start = max(start, end - timedelta(seconds=resolution * SERIES_POINTS))
+    start = epoch + timedelta(seconds=(start - epoch).total_seconds() // resolution * resolution)
+    if (end - start).total_seconds() > resolution * SERIES_POINTS:
+        start += timedelta(seconds=resolution)
+
+    if link != None:
+        where, whereParams = "link = %s", (link,)
+    elif direction == 'in':
+        where, whereParams = "to_id = %s", (node,)
+    else:
+        where, whereParams = "from_id IN (SELECT id FROM registration WHERE groupname = (SELECT name FROM node WHERE id = %s))", (node,)
+
+    if ROLLUP:
+        # hour rows only when they can't straddle two buckets
+        windows = getRollupWindows(str(start), str(end)) if resolution % 3600 == 0 else [('minute', start, end)]
+        source = getRollupSource('rollup', "bucket AS at, count, 2xx, 3xx, 4xx, 5xx, request_time, response_time", None, None, (where, whereParams), windows)
+        query = """SELECT FLOOR(TIMESTAMPDIFF(SECOND, %s, at) / %s) AS slot, SUM(count) AS count, 
+            SUM(2xx) AS 2xx, SUM(3xx) AS 3xx, SUM(4xx) AS 4xx, SUM(5xx) AS 5xx,
+            SUM(request_time) AS request_time, SUM(response_time) AS response_time
+            FROM (""" + source[0] + """) AS buckets GROUP BY slot"""
+        params = (start, resolution) + source[1]
+    else:
+        query = """SELECT FLOOR(TIMESTAMPDIFF(SECOND, %s, created_at) / %s) AS slot, COUNT(*) AS count, 
+            SUM(CASE WHEN SUBSTRING(code, 1, 1) = '2' THEN 1 ELSE 0 END) AS 2xx, 
+            SUM(CASE WHEN SUBSTRING(code, 1, 1) = '3' THEN 1 ELSE 0 END) AS 3xx,
+            SUM(CASE WHEN SUBSTRING(code, 1, 1) = '4' THEN 1 ELSE 0 END) AS 4xx, 
+            SUM(CASE WHEN SUBSTRING(code, 1, 1) = '5' THEN 1 ELSE 0 END) AS 5xx,
+            SUM(request_time) AS request_time, SUM(response_time) AS response_time
+            FROM request WHERE """+where+""" AND created_at >= %s AND created_at < %s GROUP BY slot"""
+        params = (start, resolution) + whereParams + (start, end)
+    list = execute(cursor, 'series', query, params)
     columns = cursor.description
-    serviceIds = ['0']
+    slots = {}
     for row in list:
-        node = associate(row, columns)
-
-        metadata = getMetadata(node)
-        services = getService(node, filtredNamespace)
-        trafic = getTrafic(node, services, fromDate, toDate)
-        status = getStatus(node, services, fromDate, toDate)
-        
-        serviceIds += map(lambda d: str(d['id']), services)
+        aggregate = associate(row, columns)
+        slots[int(aggregate['slot'])] = getAggregate([aggregate])
+
+    points = []
+    for slot in range(math.ceil((end - start).total_seconds() / resolution)):
+        aggregate = slots.get(slot, getAggregate())
+        points.append({
+            'at': str(start + timedelta(seconds=slot * resolution)),
+            'count': aggregate['count'],
+            '2xx': aggregate['2xx'], '3xx': aggregate['3xx'], '4xx': aggregate['4xx'], '5xx': aggregate['5xx'],
+            'success': round(100 * (aggregate['count'] - aggregate['5xx']) / aggregate['count']) if aggregate['count'] > 0 else 0,
+            'error': round(100 * aggregate['5xx'] / aggregate['count']) if aggregate['count'] > 0 else 0,
+            'time': round(aggregate['request_time'] / aggregate['count'], 3) if aggregate['count'] > 0 else 0,
+            'response_time': round(aggregate['response_time'] / aggregate['count'], 3) if aggregate['count'] > 0 else 0})
+
+    return {'node': node, 'link': link, 'direction': direction if link == None else None, 
+        'from': str(start), 'to': str(end), 'resolution': resolution, 'points': points}
+
+def getSeriesResolution(start, end, resolution):
+    # smallest known resolution keeping the window under SERIES_POINTS, never finer than rollup minutes
+    window = (end - start).total_seconds()
+    minimum = max(resolution, window / SERIES_POINTS, 60 if ROLLUP else 0)
+    for candidate in SERIES_RESOLUTIONS:
+        if candidate >= minimum:
+            return candidate
+    return SERIES_RESOLUTIONS[-1]
+
+def getGraphOptions(args):
+    # server-side pruning of /get and /stream, None when invalid
+    options = {}
+    for name in ('top', 'limit', 'around', 'hops'):
+        value = args.get(name, None)
+        if value != None:
+            if not value.isdigit():
+                return None
+            options[name] = int(value)
+    if options.get('hops', 0) > MAX_HOPS:
+        return None
+    sort = args.get('sort', None)
+    if sort != None:
+        if sort not in ('count', 'error'):
+            return None
+        options['sort'] = sort
+    if args.get('collapse', None) in ('1', 'true'):
+        options['collapse'] = True
+    return options
+
+def getGraph(fromDate, toDate, filtredNamespace, options=None):
+    options = options or {}
+    data = {'ingress': False, 'nodes': [], 'links': [], 'from': fromDate, 'to': toDate, 'namespace': filtredNamespace}
+    data.update(options)
+
+    db = connect()
+    if db == None:
+        return None
+
+    # fixed number of grouped queries, joined here whatever the node count
+    cursor = db.cursor()
+    list = execute(cursor, 'nodes', "SELECT * FROM node")
+    columns = cursor.description
+    nodes = [associate(row, columns) for row in list]
+
+    # when pruning, every following query is restricted to the kept nodes and their services
+    pruned = 'around' in options or 'limit' in options
+    if 'around' in options:
+        nodes = getNeighbourhood(nodes, options['around'], options.get('hops', 1))
+    if pruned and not len(nodes):
+        return data
+    nodeFilter = ("to_id IN (" + ','.join([str(node['id']) for node in nodes]) + ")", ()) if pruned else None
+    inbound = None
+    if 'limit' in options:
+        inbound = getAggregates('to_id', fromDate, toDate, nodeFilter)
+        groupnames = getGroupnames(filtredNamespace)
+        nodes = getTopNodes([node for node in nodes if node['name'] in groupnames], inbound, options['limit'], options.get('sort', 'count'))
+        if not len(nodes):
+            return data
+        nodeFilter = ("to_id IN (" + ','.join([str(node['id']) for node in nodes]) + ")", ())
+    groupnames = [node['name'] for node in nodes] if pruned else None
+    serviceFilter = None
+    if pruned:
+        serviceFilter = ("from_id IN (SELECT id FROM registration WHERE groupname IN (" + ','.join(['%s'] * len(groupnames)) + "))", tuple(groupnames))
+
+    # none of these depend on each other : request latency is the slowest one, not their sum
+    calls = [(getServices, (filtredNamespace, groupnames)), (getAggregates, ('from_id', fromDate, toDate, serviceFilter)),
+        (getHistograms, ('to_id', fromDate, toDate, nodeFilter)), (getAggregates, ('link', fromDate, toDate, nodeFilter)),
+        (getLinks, (filtredNamespace, groupnames, nodeFilter)), (getHistograms, ('link', fromDate, toDate, nodeFilter))]
+    if inbound == None:
+        calls.append((getAggregates, ('to_id', fromDate, toDate, nodeFilter)))
+    results = fanout(calls)
+    if None in results:
+        return None
+    (services, outbound, histograms, links, linkList, linkHistograms) = results[:6]
+    inbound = results[6] if inbound == None else inbound
+
+    serviceIds = ['0']
+    # pod id to the id standing for its collapsed service
+    representatives = {}
+    assembling = time.time()
+    for node in nodes:
+        nodeServices = services.get(node['name'], [])
+        serviceIds += map(lambda d: str(d['id']), nodeServices)
         # skeep node without service
-        if len(services) > 0:
+        if len(nodeServices) > 0:
+            nodeInbound = inbound.get(node['id'], getAggregate())
+            nodeOutbound = getAggregate([outbound[service['id']] for service in nodeServices if service['id'] in outbound])
+            nodeHistograms = getHistogram([histograms[node['id']]] if node['id'] in histograms else [])
+            if options.get('collapse'):
+                nodeServices = getCollapsedServices(nodeServices, representatives)
             data['nodes'].append({
                 'id': node['id'], 
                 'name': node['name'], 
                 'disabled': False if 1 == node['active'] else True,
-                'services': services, 
-                'metadata': metadata,
-                'trafic' : trafic,
-                'status': status})
+                'services': nodeServices, 
+                'metadata': getMetadata(node),
+                'trafic' : getTrafic(nodeInbound, nodeOutbound, nodeHistograms),
+                'status': getStatus(nodeInbound, nodeOutbound)})
 
     if not len(serviceIds) or not len(data['nodes']):
-        return json.dumps(data)
+        return data
 
-    nodeIds = map(lambda d: str(d['id']), data['nodes'])
-    cursor.execute("SELECT * FROM link WHERE from_id IN ("+','.join(serviceIds)+ ") AND to_id IN ("+','.join(nodeIds)+ ")")
-    list = cursor.fetchall()
-    columns = cursor.description
-  
-    for row in list:
-        link = associate(row, columns)
+    nodeIds = set([node['id'] for node in data['nodes']])
+    serviceIds = set(serviceIds)
+
+    # links of collapsed pods are merged into one
+    merged = OrderedDict()
+    for link in linkList:
+        if str(link['from_id']) not in serviceIds or link['to_id'] not in nodeIds:
+            continue
         if int(link['from_node_id']) == 0:
             data['ingress'] = True
+        key = (str(link['from_node_id'])+'#'+str(representatives.get(link['from_id'], link['from_id'])) if int(link['from_node_id']) != 0 else 'ingress', 
+            str(link['to_id']))
+        if key not in merged:
+            merged[key] = ([], [])
+        merged[key][0].append(links.get(link['id'], getAggregate()))
+        if link['id'] in linkHistograms:
+            merged[key][1].append(linkHistograms[link['id']])
+    for ((fromKey, toKey), (aggregates, linkHistogram)) in merged.items():
+        linkAggregate = getAggregate(aggregates)
         data['links'].append({
-            'from': str(link['from_node_id'])+'#'+str(link['from_id']) if int(link['from_node_id']) != 0 else 'ingress', 
-            'to': str(link['to_id'])})
+            'from': fromKey, 
+            'to': toKey,
+            'trafic': getLinkTrafic(linkAggregate, getHistogram(linkHistogram)),
+            'status': getStatus(linkAggregate, linkAggregate)['in']})
 
-    db.close()        
-    return json.dumps(data)
+    if 'top' in options:
+        # heaviest edges only
+        data['links'] = sorted(data['links'], key=lambda link: link['trafic']['count'], reverse=True)[:options['top']]
+        data['ingress'] = any(link['from'] == 'ingress' for link in data['links'])
+    record('assemble', time.time() - assembling)
 
-def getStatus(node, services, fromDate, toDate):
+    return data
+
+def fanout(calls):
+    if executor == None:
+        return [function(*args) for (function, args) in calls]
+    # give back the caller connection while it waits, tasks draw from the same pool
+    disconnect()
+    futures = [executor.submit(inContext, function, args, g.get('timings', None)) for (function, args) in calls]
+    return [future.result() for future in futures]
+
+def inContext(function, args, timings):
+    # own app context, so own pooled connection released on exit, timings go to the calling request
+    with api.app_context():
+        if timings != None:
+            g.timings = timings
+        if connect() == None:
+            return None
+        return function(*args)
+
+def getLinks(filtredNamespace, groupnames, filter=None):
     db = connect()
     cursor = db.cursor()
-    inQuery = """SELECT COUNT(*) AS count , 
-        SUM(CASE WHEN SUBSTRING(code, 1, 1) = '2' THEN 1 ELSE 0 END) AS 2xx, 
-        SUM(CASE WHEN SUBSTRING(code, 1, 1) = '3' THEN 1 ELSE 0 END) AS 3xx,
-        SUM(CASE WHEN SUBSTRING(code, 1, 1) = '4' THEN 1 ELSE 0 END) AS 4xx, 
-        SUM(CASE WHEN SUBSTRING(code, 1, 1) = '5' THEN 1 ELSE 0 END) AS 5xx
-        FROM request WHERE to_id = %s
-    """
-    inQueryParams = (node['id'],)
-    if fromDate != None and fromDate != '':
-        inQuery += " AND created_at > %s"
-        inQueryParams += (fromDate,)
-    if toDate != None and toDate != '':
-        inQuery += " AND created_at < %s "
-        inQueryParams += (toDate,)
-    cursor.execute(inQuery, inQueryParams)
-
-    row = cursor.fetchone()
+    query, params = "SELECT * FROM link WHERE (from_id = 0 OR from_id IN (SELECT id FROM registration WHERE active = 1", ()
+    if(filtredNamespace != None and filtredNamespace != ''):
+        query += " AND namespace = %s"
+        params += (filtredNamespace,)
+    if groupnames != None:
+        query += " AND groupname IN (" + ','.join(['%s'] * len(groupnames)) + ")"
+        params += tuple(groupnames)
+    query += "))"
+    if filter != None:
+        query += " AND " + filter[0]
+        params += filter[1]
+    list = execute(cursor, 'links', query, params)
     columns = cursor.description
-    statusIn = associate(row, columns)
+    return [associate(row, columns) for row in list]
+
+def getNeighbourhood(nodes, around, hops):
+    # nodes at most hops links away from around, whatever the link direction
+    db = connect()
+    cursor = db.cursor()
+    neighbours = {}
+    for (fromId, toId) in execute(cursor, 'neighbourhood', "SELECT DISTINCT from_node_id, to_id FROM link WHERE from_node_id != 0"):
+        neighbours.setdefault(int(fromId), set()).add(int(toId))
+        neighbours.setdefault(int(toId), set()).add(int(fromId))
+    kept, frontier = {around}, {around}
+    for hop in range(hops):
+        frontier = set().union(*[neighbours.get(id, set()) for id in frontier]) - kept
+        if not frontier:
+            break
+        kept |= frontier
+    return [node for node in nodes if node['id'] in kept]
 
-    serviceIds = []
+def getTopNodes(nodes, inbound, limit, sort):
+    def weight(node):
+        aggregate = inbound.get(node['id'], getAggregate())
+        if sort == 'error':
+            return (aggregate['5xx'] / aggregate['count'] if aggregate['count'] else 0, aggregate['count'])
+        return (aggregate['count'], aggregate['5xx'])
+    return sorted(nodes, key=weight, reverse=True)[:limit]
+
+def getCollapsedServices(services, representatives):
+    # one entry per service (pods sharing namespace and name) with its pod count
+    collapsed = OrderedDict()
     for service in services:
-        serviceIds.append(str(service['id']))
-    
-    if not len(serviceIds):
-        return {}
-
-    outQuery = """SELECT COUNT(*) AS count , 
-        SUM(CASE WHEN SUBSTRING(code, 1, 1) = '2' THEN 1 ELSE 0 END) AS 2xx, 
-        SUM(CASE WHEN SUBSTRING(code, 1, 1) = '3' THEN 1 ELSE 0 END) AS 3xx,
-        SUM(CASE WHEN SUBSTRING(code, 1, 1) = '4' THEN 1 ELSE 0 END) AS 4xx, 
-        SUM(CASE WHEN SUBSTRING(code, 1, 1) = '5' THEN 1 ELSE 0 END) AS 5xx
-        FROM request WHERE from_id IN ("""+','.join(serviceIds)+ """)
-    """
-    outQueryParams = ()
-    if fromDate != None and fromDate != '':
-        outQuery += " AND created_at > %s"
-        outQueryParams += (fromDate,)
-    if toDate != None and toDate != '':
-        outQuery += " AND created_at < %s "
-        outQueryParams += (toDate,)
+        key = (service['namespace'], service['name'])
+        if key not in collapsed:
+            collapsed[key] = dict(service, pods=0)
+        collapsed[key]['pods'] += 1
+        representatives[service['id']] = collapsed[key]['id']
+    return [service for service in collapsed.values()]
 
-    cursor.execute(outQuery, outQueryParams)
-    row = cursor.fetchone()
-    columns = cursor.description
-    statusOut = associate(row, columns)
-    
+def getStatus(inbound, outbound):
     inState = {}
     index = ['2xx', '3xx', '4xx', '5xx']
     for column in index:
-        inState[column] = round(100 * int(statusIn[column]) / int(statusIn['count'])) if statusIn['count'] and int(statusIn['count']) > 0 else 0
+        inState[column] = round(100 * int(inbound[column]) / int(inbound['count'])) if inbound['count'] and int(inbound['count']) > 0 else 0
     outState = {}
     for column in index:
-        outState[column] = round(100 * int(statusOut[column]) / int(statusOut['count'])) if statusOut['count'] and int(statusOut['count']) > 0 else 0
+        outState[column] = round(100 * int(outbound[column]) / int(outbound['count'])) if outbound['count'] and int(outbound['count']) > 0 else 0
     return {'in' : inState, 'out': outState} 
 
-def getTrafic(node, services, fromDate, toDate):
+def getTrafic(inbound, outbound, histograms):
+    trafic = {
+        'in' : {
+            'time': round(inbound['request_time'] / inbound['count'], 3) if inbound['count'] > 0 else 0, 
+            'success': round(100 * (inbound['count'] - inbound['5xx']) / inbound['count']) if inbound['count'] > 0 else 0, 
+            'error': round(100 * inbound['5xx'] / inbound['count']) if inbound['count'] > 0 else 0},
+        'out' : {
+            'time': round(inbound['response_time'] / inbound['count'], 3) if inbound['count'] > 0 else 0, 
+            'success': round(100 * (outbound['count'] - outbound['5xx']) / outbound['count']) if outbound['count'] > 0 else 0, 
+            'error': round(100 * outbound['5xx'] / outbound['count']) if outbound['count'] > 0 else 0}
+    } 
+    # request_time percentiles go with 'in', response_time ones with 'out' (like their averages)
+    for (direction, metric) in (('in', 0), ('out', 1)):
+        for percentile in (50, 95, 99):
+            trafic[direction]['p'+str(percentile)] = getPercentile(histograms[metric], percentile)
+    return trafic
+
+def getLinkTrafic(aggregate, histograms):
+    count = aggregate['count']
+    trafic = {
+        'count': count,
+        'time': round(aggregate['request_time'] / count, 3) if count > 0 else 0,
+        'response_time': round(aggregate['response_time'] / count, 3) if count > 0 else 0,
+        'success': round(100 * (count - aggregate['5xx']) / count) if count > 0 else 0,
+        'error': round(100 * aggregate['5xx'] / count) if count > 0 else 0}
+    # same naming as the averages : pNN for request_time, response_pNN for response_time
+    for percentile in (50, 95, 99):
+        trafic['p'+str(percentile)] = getPercentile(histograms[0], percentile)
+        trafic['response_p'+str(percentile)] = getPercentile(histograms[1], percentile)
+    return trafic
+
+def getHistogram(histograms = ()):
+    # sum of histograms, empty bins when none
+    histogram = {0: [0] * HISTOGRAM_BINS, 1: [0] * HISTOGRAM_BINS}
+    for item in histograms:
+        for metric in (0, 1):
+            histogram[metric] = [a + b for (a, b) in zip(histogram[metric], item[metric])]
+    return histogram
+
+def getHistograms(column, fromDate, toDate, filter=None):
     db = connect()
     cursor = db.cursor()
+    source = getRollupSource('histogram', column+" AS id, metric, bin, count", fromDate, toDate, filter) if ROLLUP else None
+    if source == None:
+        # same binning as the processor, computed over raw rows
+        where, whereParams = getRawFilter(fromDate, toDate, filter)
+        parts, params = [], ()
+        for (metric, timeColumn) in ((0, 'request_time'), (1, 'response_time')):
+            parts.append("""SELECT """+column+""" AS id, """+str(metric)+""" AS metric, CASE WHEN """+timeColumn+""" <= %s THEN 0
+                ELSE LEAST(FLOOR(LN("""+timeColumn+""" / %s) / LN(%s)) + 1, %s) END AS bin, 1 AS count
+                FROM request WHERE """+where)
+            params += (HISTOGRAM_MIN, HISTOGRAM_MIN, HISTOGRAM_GROWTH, HISTOGRAM_BINS - 1) + whereParams
+        source = (" UNION ALL ".join(parts), params)
+    histograms = {}
+    for (id, metric, bin, count) in execute(cursor, 'histograms_' + column, "SELECT id, metric, bin, SUM(count) FROM (" + source[0] + ") AS bins GROUP BY id, metric, bin", source[1]):
+        if id not in histograms:
+            histograms[id] = {0: [0] * HISTOGRAM_BINS, 1: [0] * HISTOGRAM_BINS}
+        histograms[id][int(metric)][int(bin)] += int(count)
+    return histograms
 
-    inTimeQuery = "SELECT AVG(request_time) FROM request WHERE to_id = %s"
-    inTimeQueryParams = (node['id'],)
-    if fromDate != None and fromDate != '':
-        inTimeQuery += " AND created_at > %s "
-        inTimeQueryParams += (fromDate,)
-    if toDate != None and toDate != '':
-        inTimeQuery += " AND created_at < %s "
-        inTimeQueryParams += (toDate,)
-    cursor.execute(inTimeQuery, inTimeQueryParams)
-    inTime = cursor.fetchone()
+def getPercentile(histogram, percentile):
+    total = sum(histogram)
+    if not total:
+        return 0
+    rank = math.ceil(total * percentile / 100)
+    seen = 0
+    for (bin, count) in enumerate(histogram):
+        seen += count
+        if seen >= rank:
+            # geometric middle of the bin, bin 0 holds everything under the minimum
+            return round(HISTOGRAM_MIN * math.pow(HISTOGRAM_GROWTH, bin - 0.5), 3) if bin > 0 else HISTOGRAM_MIN
+    return 0
 
-    outTimeQuery = "SELECT AVG(response_time) FROM request WHERE to_id = %s"
-    outTimeQueryParams = (node['id'],)
-    if fromDate != None and fromDate != '':
-        outTimeQuery += " AND created_at > %s  "
-        outTimeQueryParams += (fromDate,)
-    if toDate != None and toDate != '':
-        outTimeQuery += " AND created_at < %s  "
-        outTimeQueryParams += (toDate,)
-    cursor.execute(outTimeQuery, outTimeQueryParams)
-    outTime = cursor.fetchone()
-
-    inQuery = """SELECT COUNT(*) AS count , SUM(CASE WHEN SUBSTRING(code, 1, 1) != '5' THEN 1 ELSE 0 END) 
-        AS success, SUM(CASE WHEN SUBSTRING(code, 1, 1) = '5' THEN 1 ELSE 0 END) AS error 
-        FROM request WHERE to_id = %s
-    """
-    inQueryParams = (node['id'],)
-    if fromDate != None and fromDate != '':
-        inQuery += " AND created_at > %s  "
-        inQueryParams += (fromDate,)
-    if toDate != None and toDate != '':
-        inQuery += " AND created_at < %s  "
-        inQueryParams += (toDate,)
-
-    cursor.execute(inQuery, inQueryParams)
-    row = cursor.fetchone()
+def getAggregates(column, fromDate, toDate, filter=None):
+    db = connect()
+    cursor = db.cursor()
+    source = getRollupSource('rollup', column+" AS id, count, 2xx, 3xx, 4xx, 5xx, request_time, response_time", fromDate, toDate, filter) if ROLLUP else None
+    if source == None:
+        where, params = getRawFilter(fromDate, toDate, filter)
+        query = """SELECT """+column+""" AS id, COUNT(*) AS count, 
+            SUM(CASE WHEN SUBSTRING(code, 1, 1) = '2' THEN 1 ELSE 0 END) AS 2xx, 
+            SUM(CASE WHEN SUBSTRING(code, 1, 1) = '3' THEN 1 ELSE 0 END) AS 3xx,
+            SUM(CASE WHEN SUBSTRING(code, 1, 1) = '4' THEN 1 ELSE 0 END) AS 4xx, 
+            SUM(CASE WHEN SUBSTRING(code, 1, 1) = '5' THEN 1 ELSE 0 END) AS 5xx,
+            SUM(request_time) AS request_time, SUM(response_time) AS response_time
+            FROM request WHERE """+where+""" GROUP BY """+column
+    else:
+        query = """SELECT id, SUM(count) AS count, SUM(2xx) AS 2xx, SUM(3xx) AS 3xx, SUM(4xx) AS 4xx, SUM(5xx) AS 5xx,
+            SUM(request_time) AS request_time, SUM(response_time) AS response_time
+            FROM (""" + source[0] + """) AS buckets GROUP BY id"""
+        params = source[1]
+    list = execute(cursor, 'aggregates_' + column, query, params)
     columns = cursor.description
-    stateIn = associate(row, columns)
-
-    serviceIds = []
-    for service in services:
-        serviceIds.append(str(service['id']))
+    aggregates = {}
+    for row in list:
+        aggregate = associate(row, columns)
+        aggregates[aggregate['id']] = getAggregate([aggregate])
+    return aggregates
 
-    if not len(serviceIds):
-        return { } 
+def getAggregate(aggregates = ()):
+    # sum of aggregates, zero counters when empty
+    aggregate = {'count': 0, '2xx': 0, '3xx': 0, '4xx': 0, '5xx': 0, 'request_time': 0.0, 'response_time': 0.0}
+    for item in aggregates:
+        for key in ['count', '2xx', '3xx', '4xx', '5xx']:
+            aggregate[key] += int(item[key]) if item[key] else 0
+        for key in ['request_time', 'response_time']:
+            aggregate[key] += float(item[key]) if item[key] else 0.0
+    return aggregate
 
-    outQuery = """SELECT COUNT(*) AS count , SUM(CASE WHEN SUBSTRING(code, 1, 1) != '5' THEN 1 ELSE 0 END) 
-        AS success, SUM(CASE WHEN SUBSTRING(code, 1, 1) = '5' THEN 1 ELSE 0 END) AS error 
-        FROM request WHERE from_id IN (""" + ','.join(serviceIds) +""")
-    """
-    outQueryParams = ()
+def getRawFilter(fromDate, toDate, filter=None):
+    where, params = "1 = 1", ()
+    if filter != None:
+        where += " AND " + filter[0]
+        params += filter[1]
     if fromDate != None and fromDate != '':
-        outQuery += " AND created_at > %s "
-        outQueryParams += (fromDate,)
+        where += " AND created_at > %s"
+        params += (fromDate,)
     if toDate != None and toDate != '':
-        outQuery += " AND created_at < %s "
-        outQueryParams += (toDate,)
-        
-    cursor.execute(outQuery, outQueryParams)
-    row = cursor.fetchone()
-    columns = cursor.description
-    stateOut = associate(row, columns)
-    return {
-        'in' : {
-            'time': round(inTime[0] if inTime[0] else 0, 3), 
-            'success': round(100 * int(stateIn['success']) / int(stateIn['count'])) if int(stateIn['count']) > 0 else 0, 
-            'error': round(100 * int(stateIn['error']) / int(stateIn['count'])) if int(stateIn['count']) > 0 else 0},
-        'out' : {
-            'time': round(outTime[0] if outTime[0] else 0, 3), 
-            'success': round(100 * int(stateOut['success']) / int(stateOut['count'])) if int(stateOut['count']) > 0 else 0, 
-            'error': round(100 * int(stateOut['error']) / int(stateOut['count'])) if int(stateOut['count']) > 0 else 0}
-    } 
+        where += " AND created_at < %s "
+        params += (toDate,)
+    return (where, params)
 
-def getService(node, filtredNamespace):
+def getRollupSource(table, columns, fromDate, toDate, where=None, windows=None):
+    # whole hours come from the hour table and the window edges from the minute one
+    if windows == None:
+        windows = getRollupWindows(fromDate, toDate)
+    if windows == None:
+        return None
+    parts, params = [], ()
+    for (tier, start, end) in windows:
+        part = "SELECT "+columns+" FROM "+table+"_"+tier+" WHERE 1 = 1"
+        if where != None:
+            part += " AND " + where[0]
+            params += where[1]
+        if start != None:
+            part += " AND bucket >= %s"
+            params += (start,)
+        if end != None:
+            part += " AND bucket < %s"
+            params += (end,)
+        parts.append(part)
+    return (" UNION ALL ".join(parts), params)
+
+def getRollupWindows(fromDate, toDate):
+    start, end = parseDate(fromDate), parseDate(toDate)
+    if start == False or end == False:
+        # unknown date format, let raw query handle it
+        return None
+    hourStart = start.replace(minute=0, second=0, microsecond=0) if start else None
+    if hourStart and hourStart < start:
+        hourStart += timedelta(hours=1)
+    hourEnd = end.replace(minute=0, second=0, microsecond=0) if end else None
+    if hourStart and hourEnd and hourStart >= hourEnd:
+        return [('minute', start, end)]
+    windows = [('hour', hourStart, hourEnd)]
+    if start and start < hourStart:
+        windows.append(('minute', start, hourStart))
+    if end and hourEnd < end:
+        windows.append(('minute', hourEnd, end))
+    return windows
+
+def parseDate(value):
+    if value == None or value == '':
+        return None
+    try:
+        date = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return False
+    if date.tzinfo:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+def getServices(filtredNamespace, groupnames=None):
     db = connect()
-    services = []
+    services = {}
     cursor = db.cursor()
+    query, params = "SELECT * FROM registration WHERE active = 1", ()
     if(filtredNamespace != None and filtredNamespace != ''):
-        cursor.execute("SELECT * FROM registration WHERE groupname = %s AND namespace = %s AND active = 1", (node['name'],filtredNamespace))
-    else :
-        cursor.execute("SELECT * FROM registration WHERE groupname = %s AND active = 1", (node['name'],))
-    list = cursor.fetchall()
+        query += " AND namespace = %s"
+        params += (filtredNamespace,)
+    if groupnames != None:
+        if not len(groupnames):
+            return services
+        query += " AND groupname IN (" + ','.join(['%s'] * len(groupnames)) + ")"
+        params += tuple(groupnames)
+    list = execute(cursor, 'services', query, params)
     columns = cursor.description
     for row in list:
         service = associate(row, columns)
-        services.append({
+        if service['groupname'] not in services:
+            services[service['groupname']] = []
+        services[service['groupname']].append({
             'name': service['service'] if service['service'] else service['pod'] ,
             'id': service['id'],
             'host': service['host'],
@@ -275,6 +892,15 @@ def getService(node, filtredNamespace):
         })
     return services
 
+def getGroupnames(filtredNamespace):
+    db = connect()
+    cursor = db.cursor()
+    if(filtredNamespace != None and filtredNamespace != ''):
+        list = execute(cursor, 'groupnames', "SELECT DISTINCT groupname FROM registration WHERE namespace = %s AND active = 1", (filtredNamespace,))
+    else :
+        list = execute(cursor, 'groupnames', "SELECT DISTINCT groupname FROM registration WHERE active = 1")
+    return set([row[0] for row in list])
+
 def getMetadata(node):
     return [
         {'name': 'Group ID', 'value' : '#'+str(node['id'])},
@@ -283,6 +909,91 @@ def getMetadata(node):
     ]
 
 def connect():
+    # one pooled connection per HTTP request, given back on teardown
+    if 'db' in g:
+        return g.db
+    db = acquire()
+    if db != None:
+        g.db = db
+    return db
+
+@api.teardown_appcontext
+def teardown(exception):
+    disconnect()
+
+def disconnect():
+    db = g.pop('db', None)
+    if db != None:
+        release(db)
+
+def acquire():
+    tic = time.time()
+    conn = None
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        with poolLock:
+            create = poolStats['size'] < POOL_SIZE
+            if create:
+                poolStats['size'] += 1
+        if create:
+            conn = newConnection()
+            if conn == None:
+                with poolLock:
+                    poolStats['size'] -= 1
+                    poolStats['errors'] += 1
+                return None
+        else:
+            with poolLock:
+                poolStats['waits'] += 1
+            try:
+                conn = pool.get(timeout=POOL_WAIT)
+            except queue.Empty:
+                with poolLock:
+                    poolStats['timeouts'] += 1
+                return None
+    try:
+        # health check, reconnect a connection dropped by the server
+        conn.ping(reconnect=True, attempts=1, delay=0)
+    except Error as e:
+        with poolLock:
+            poolStats['size'] -= 1
+            poolStats['errors'] += 1
+        return None
+    wait = time.time() - tic
+    with poolLock:
+        poolStats['checkouts'] += 1
+        poolStats['in_use'] += 1
+        poolStats['wait_time'] += wait
+        poolStats['max_wait_time'] = max(poolStats['max_wait_time'], wait)
+        checkouts[id(conn)] = time.time()
+    return conn
+
+def release(conn):
+    with poolLock:
+        held = time.time() - checkouts.pop(id(conn), time.time())
+        poolStats['in_use'] -= 1
+        poolStats['checkout_time'] += held
+        poolStats['max_checkout_time'] = max(poolStats['max_checkout_time'], held)
+    try:
+        # end the transaction (and its read snapshot) before reuse
+        conn.rollback()
+        pool.put(conn)
+    except Error as e:
+        with poolLock:
+            poolStats['size'] -= 1
+            poolStats['errors'] += 1
+
+def getPoolStats():
+    with poolLock:
+        stats = dict(poolStats)
+    stats['limit'] = POOL_SIZE
+    stats['idle'] = pool.qsize()
+    stats['avg_wait_time'] = round(stats['wait_time'] / stats['checkouts'], 6) if stats['checkouts'] else 0
+    stats['avg_checkout_time'] = round(stats['checkout_time'] / stats['checkouts'], 6) if stats['checkouts'] else 0
+    return stats
+
+def newConnection():
     try:
         conn = mysql.connector.connect(host=os.environ["DB_HOST"], database=os.environ["DB_NAME"], user=os.environ["DB_USER"],password=os.environ["DB_PASSWORD"])
         if conn.is_connected():
@@ -291,6 +1002,66 @@ def connect():
     except Error as e:
         return None
 
+def execute(cursor, name, query, params=()):
+    tic = time.time()
+    cursor.execute(query, params)
+    list = cursor.fetchall()
+    duration = time.time() - tic
+    record(name, duration, len(list))
+    observe('query', name, duration)
+    if duration * 1000 > SLOW_QUERY_MS:
+        api.logger.warning("Slow query %s (%.1f ms, %d rows) : %s %s", name, duration * 1000, len(list), ' '.join(query.split()), params)
+    return list
+
+def record(name, duration, rows=None):
+    # per request timings, for Server-Timing header
+    if 'timings' in g:
+        g.timings.append((name, duration, rows))
+
+@contextmanager
+def timed(name):
+    tic = time.time()
+    try:
+        yield
+    finally:
+        record(name, time.time() - tic)
+
+def observe(metric, label, duration):
+    with metricsLock:
+        if label not in metrics[metric]:
+            metrics[metric][label] = {'buckets': [0] * len(METRICS_BUCKETS), 'sum': 0.0, 'count': 0}
+        histogram = metrics[metric][label]
+        for (index, bound) in enumerate(METRICS_BUCKETS):
+            if duration <= bound:
+                histogram['buckets'][index] += 1
+                break
+        histogram['sum'] += duration
+        histogram['count'] += 1
+
+def getMetrics():
+    # prometheus text format, per process (per gunicorn worker)
+    lines = []
+    for (metric, label, help) in (('request', 'endpoint', 'HTTP request duration by endpoint'), ('query', 'query', 'MySQL query duration by query name')):
+        name = 'sms_api_' + metric + '_duration_seconds'
+        lines += ['# HELP ' + name + ' ' + help, '# TYPE ' + name + ' histogram']
+        with metricsLock:
+            histograms = {key: dict(value, buckets=list(value['buckets'])) for (key, value) in metrics[metric].items()}
+        for (key, histogram) in sorted(histograms.items()):
+            cumulative = 0
+            for (bound, count) in zip(METRICS_BUCKETS, histogram['buckets']):
+                cumulative += count
+                lines.append(name + '_bucket{' + label + '="' + key + '",le="' + str(bound) + '"} ' + str(cumulative))
+            lines.append(name + '_bucket{' + label + '="' + key + '",le="+Inf"} ' + str(histogram['count']))
+            lines.append(name + '_sum{' + label + '="' + key + '"} ' + str(histogram['sum']))
+            lines.append(name + '_count{' + label + '="' + key + '"} ' + str(histogram['count']))
+    pool = getPoolStats()
+    lines += ['# HELP sms_api_pool_connections MySQL pool connections by state', '# TYPE sms_api_pool_connections gauge',
+        'sms_api_pool_connections{state="in_use"} ' + str(pool['in_use']), 'sms_api_pool_connections{state="idle"} ' + str(pool['idle'])]
+    cache = getCacheStats()
+    lines += ['# HELP sms_api_cache_total Response cache lookups by result', '# TYPE sms_api_cache_total counter']
+    lines += ['sms_api_cache_total{result="' + result + '"} ' + str(cache[result]) for result in ('hits', 'misses', 'coalesced', 'not_modified')]
+    return '\n'.join(lines) + '\n'
+
 def associate(data, columns):
     row = {}
     for (index,column) in enumerate(data):
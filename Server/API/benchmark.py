@@ -0,0 +1,53 @@
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import encoding
+
+def mesh(groups, pods, links):
+    # same shape as getGraph() output
+    data = {'ingress': True, 'nodes': [], 'links': [], 'from': None, 'to': None, 'namespace': None}
+    ids = []
+    for group in range(1, groups + 1):
+        services = []
+        for pod in range(pods):
+            id = group * pods + pod
+            ids.append((group, id))
+            services.append({'name': 'service-%d' % group, 'id': id, 'host': 'service-%d-%08x-%05d' % (group, random.getrandbits(32), pod),
+                'pod': 'service-%d-%08x-%05d' % (group, random.getrandbits(32), pod), 'ip': '10.%d.%d.%d' % (group // 256, group % 256, pod),
+                'port': 8080, 'namespace': 'namespace-%d' % (group % 20)})
+        trafic = {}
+        for direction in ('in', 'out'):
+            trafic[direction] = {'time': round(random.random(), 3), 'success': random.randint(80, 100), 'error': random.randint(0, 20),
+                'p50': round(random.random(), 3), 'p95': round(random.random() * 2, 3), 'p99': round(random.random() * 4, 3)}
+        data['nodes'].append({'id': group, 'name': 'group-%d' % group, 'disabled': False, 'services': services,
+            'metadata': [{'name': 'Group ID', 'value': '#%d' % group}, {'name': 'Group name', 'value': 'group-%d' % group},
+                {'name': 'Creation date', 'value': datetime(2020, 5, 1) + timedelta(seconds=random.randint(0, 86400))}],
+            'trafic': trafic,
+            'status': {direction: {'2xx': random.randint(60, 100), '3xx': random.randint(0, 10), '4xx': random.randint(0, 10), '5xx': random.randint(0, 20)} for direction in ('in', 'out')}})
+    for index in range(links):
+        (group, id) = random.choice(ids)
+        count = random.randint(1, 100000)
+        data['links'].append({'from': '%d#%d' % (group, id), 'to': str(random.randint(1, groups)),
+            'trafic': {'count': count, 'time': round(random.random(), 3), 'response_time': round(random.random(), 3), 'success': random.randint(80, 100), 'error': random.randint(0, 20)},
+            'status': {'2xx': random.randint(60, 100), '3xx': random.randint(0, 10), '4xx': random.randint(0, 10), '5xx': random.randint(0, 20)}})
+    return data
+
+def measure(data, format, contentEncoding, runs):
+    tic = time.perf_counter()
+    for run in range(runs):
+        (body, applied) = encoding.encode(data, format, contentEncoding)
+    toc = time.perf_counter()
+    print("{:<10} {:<6} {:>10} bytes {:>9.1f} ms".format(format, contentEncoding or '-', len(body), 1000 * (toc - tic) / runs))
+
+if __name__ == '__main__':
+    groups = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    pods = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    runs = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    random.seed(42)
+    data = mesh(groups, pods, groups * pods * 2)
+    print("Encoding a generated mesh of {} groups, {} pods, {} links ({} runs)".format(groups, groups * pods, groups * pods * 2, runs))
+    for format in ['json', 'columnar'] + (['msgpack'] if encoding.msgpack else []):
+        for contentEncoding in [None, 'gzip'] + (['br'] if encoding.brotli else []):
+            measure(data, format, contentEncoding, runs)
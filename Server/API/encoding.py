@@ -0,0 +1,76 @@
+from flask import json
+from datetime import datetime
+from werkzeug.http import http_date
+import gzip
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# bodies under COMPRESS_MIN_SIZE bytes are sent as is
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", 1024))
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", 6))
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", 5))
+
+# format query parameter (or Accept header for msgpack) to content type
+FORMATS = {'json': 'application/json', 'columnar': 'application/json', 'msgpack': 'application/msgpack'}
+
+def getFormat(args, accept):
+    format = args.get('format', None)
+    if format == None:
+        types = ['application/json', 'application/msgpack', 'application/x-msgpack'] if msgpack else ['application/json']
+        format = 'msgpack' if 'msgpack' in accept.best_match(types, default='application/json') else 'json'
+    if format not in FORMATS or (format == 'msgpack' and msgpack == None):
+        return None
+    return format
+
+def getContentEncoding(acceptEncodings):
+    return acceptEncodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+
+def getHeaders(format, contentEncoding):
+    headers = {'Content-Type': FORMATS[format], 'Vary': 'Accept, Accept-Encoding'}
+    if contentEncoding:
+        headers['Content-Encoding'] = contentEncoding
+    return headers
+
+def encode(data, format, contentEncoding):
+    return compress(serialize(data, format), contentEncoding)
+
+def serialize(data, format):
+    if format == 'msgpack':
+        return msgpack.packb(data, default=getDefault, use_bin_type=True)
+    if format == 'columnar':
+        data = toColumns(data)
+    return json.dumps(data).encode('utf-8')
+
+def compress(body, contentEncoding):
+    if contentEncoding == None or len(body) < COMPRESS_MIN_SIZE:
+        return (body, None)
+    if contentEncoding == 'br':
+        return (brotli.compress(body, quality=BROTLI_QUALITY), 'br')
+    return (gzip.compress(body, GZIP_LEVEL), 'gzip')
+
+def toColumns(value):
+    # list of objects become one object of parallel arrays, keys are written once
+    if isinstance(value, dict):
+        return {key: toColumns(item) for (key, item) in value.items()}
+    if isinstance(value, list) and len(value) and all(isinstance(item, dict) for item in value):
+        keys = []
+        for item in value:
+            keys += [key for key in item if key not in keys]
+        return {key: [toColumns(item.get(key, None)) for item in value] for key in keys}
+    if isinstance(value, list):
+        return [toColumns(item) for item in value]
+    return value
+
+def getDefault(value):
+    # same date rendering as flask json
+    if isinstance(value, datetime):
+        return http_date(value)
+    return str(value)
@@ -0,0 +1,12 @@
+import os
+
+# production serving : WORKERS processes of THREADS threads, each process has its own pool, cache and streams
+bind = '0.0.0.0:5000'
+workers = int(os.environ.get("WORKERS", 2))
+# an open /stream holds one thread (mostly idle, waiting for the next tick), at most STREAM_MAX of them per process,
+# THREADS - 8 by default so 8 threads always serve /get and the other endpoints
+threads = int(os.environ.get("THREADS", 32))
+worker_class = 'gthread'
+timeout = int(os.environ.get("TIMEOUT", 60))
+keepalive = 5
+accesslog = '-'